@@ -0,0 +1,48 @@
+from xmlbackend import open_and_close_tags, tostring
+
+
+class DocumentAssembler:
+    """
+    Builds single-part MusicXML documents of a score from serialized fragments.
+
+    The header, the metadata sections (as selected by copy_metadata_sections) and every measure
+    are serialized once; a document is then the concatenation of cached fragments, written with
+    a single call. Call invalidate() after mutating a measure whose fragment may be cached.
+    """
+
+    def __init__(self, root, metadata_tags=('defaults', 'part-list')):
+        root_open, self.root_close = open_and_close_tags(root.tag, root.attrib)
+        self.header = b'<?xml version="1.0" encoding="UTF-8"?>\n' + root_open + b''.join(
+            tostring(child) for child in root if child.tag in metadata_tags)
+        self._parts = {}
+        self._fragments = {}
+
+    def part_tags(self, part_id):
+        """Returns the serialized start and end tags of a part."""
+        if part_id not in self._parts:
+            self._parts[part_id] = open_and_close_tags('part', {'id': part_id})
+        return self._parts[part_id]
+
+    def measure_bytes(self, measure):
+        """Returns the serialized measure, serializing it on first use."""
+        fragment = self._fragments.get(id(measure))
+        if fragment is None:
+            # Keep a reference to the measure so its id cannot be reused while it is cached
+            fragment = (measure, tostring(measure))
+            self._fragments[id(measure)] = fragment
+        return fragment[1]
+
+    def invalidate(self, measure):
+        """Drops the cached fragment of a measure that has been mutated."""
+        self._fragments.pop(id(measure), None)
+
+    def document(self, part_id, measures):
+        """Returns the bytes of a document with the given measures in a single part."""
+        part_open, part_close = self.part_tags(part_id)
+        return b''.join([self.header, part_open, *(self.measure_bytes(measure) for measure in measures),
+                         part_close, self.root_close])
+
+    def write(self, file_path, part_id, measures):
+        """Writes a document with the given measures in a single part."""
+        with open(file_path, 'wb') as f:
+            f.write(self.document(part_id, measures))
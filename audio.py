@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class AudioExporter:
+    """
+    Exports finished section files to audio in the background.
+
+    Sections are queued with submit() and converted to every format in `formats` (e.g. 'wav',
+    'mp3') through MuseScore job files, batch_size sections per renderer start, on a pool of
+    `workers` threads of its own. Exports therefore overlap with the layout search and PDF
+    renders of later sections. Give the exporter its own renderer, so that audio exports do
+    not count as layout renders. flush() sends the remaining sections and waits for all
+    exports; close() also shuts the pool down.
+    """
+
+    def __init__(self, renderer, formats=('wav',), workers=1, batch_size=8):
+        self.renderer = renderer
+        self.formats = tuple(formats)
+        self.batch_size = max(1, batch_size)
+        self.exported = 0
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._pending = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def audio_paths(self, xml_path):
+        """Returns the audio files a section file is exported to."""
+        base = os.path.splitext(xml_path)[0]
+        return [f'{base}.{audio_format}' for audio_format in self.formats]
+
+    def submit(self, xml_path, overwrite=True):
+        """
+        Queues a section file for export. With overwrite=False only the missing audio files are
+        exported, e.g. for sections kept from an earlier run.
+        """
+        jobs = [(xml_path, audio_path) for audio_path in self.audio_paths(xml_path)
+                if overwrite or not os.path.exists(audio_path)]
+        with self._lock:
+            self._pending.extend(jobs)
+            if len(self._pending) >= self.batch_size * len(self.formats):
+                self._send()
+
+    def _send(self):
+        """Hands the queued jobs to the pool as one batch. Called with the lock held."""
+        if self._pending:
+            self._futures.append(self._pool.submit(self._export, self._pending))
+            self._pending = []
+
+    def _export(self, jobs):
+        self.renderer.convert_job_file(jobs)
+        with self._lock:
+            self.exported += len(jobs)
+        logger.info("Exported %s audio files", len(jobs))
+
+    def flush(self):
+        """Sends the queued sections and waits for every export, raising the first export error."""
+        with self._lock:
+            self._send()
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Waits for every export and shuts down the pool."""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
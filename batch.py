@@ -0,0 +1,128 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import shlex
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+
+import iterative_split
+import split
+from audio import AudioExporter
+from common import SplitResult
+from instrument import Trace
+from render import AsyncRenderer
+from render_cache import RenderCache
+
+
+logger = logging.getLogger(__name__)
+
+
+SPLITTERS = {
+    'split': (split.split_musicxml_by_page, 'mscore3'),
+    'iterative': (iterative_split.split_musicxml_by_page, 'musescore-portable-nightly'),
+}
+
+
+def split_work(file_path, output_dir, mode='split', binary=None, cache_dir=None, trace=False, timeout=300,
+               audio_formats=()):
+    """
+    Splits one score into its own output directory, which doubles as its scratch directory.
+    Runs in a worker process, so every failure is caught and returned in the SplitResult.
+    With trace=True the per-phase timings are also written to <output_dir>/trace.json.
+    A renderer run that takes longer than timeout seconds per converted file is killed and retried.
+    Every section is also exported to each of audio_formats, e.g. ('wav', 'mp3').
+    """
+    splitter, default_binary = SPLITTERS[mode]
+    cache = RenderCache(cache_dir) if cache_dir else None
+    start_time = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        with AsyncRenderer(binary or default_binary, cache=cache, trace=Trace() if trace else None,
+                           timeout=timeout) as renderer:
+            if audio_formats:
+                with AudioExporter(AsyncRenderer(binary or default_binary, timeout=timeout), audio_formats) as audio:
+                    result = splitter(file_path, output_dir, renderer=renderer, audio=audio)
+            else:
+                result = splitter(file_path, output_dir, renderer=renderer)
+            renderer.trace.export(os.path.join(output_dir, 'trace.json'))
+            return result
+    except Exception as e:
+        result = SplitResult(file_path, output_dir, error=f"{type(e).__name__}: {e}")
+        result.seconds = time.perf_counter() - start_time
+        traceback.print_exc()
+        return result
+
+
+def run_batch(input_dir, output_root='split_musicxml', mode='split', workers=None, binary=None, cache_dir=None,
+              extension='.musicxml', trace=False, timeout=300, audio_formats=()):
+    """
+    Splits every score in input_dir on a process pool, writing each work to output_root/<work>.
+    Returns the SplitResults, in file name order, and writes manifest.json and manifest.csv
+    to output_root.
+    """
+    file_names = sorted(name for name in os.listdir(input_dir) if name.endswith(extension))
+    os.makedirs(output_root, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(split_work, os.path.join(input_dir, name),
+                               os.path.join(output_root, name[:-len(extension)]), mode, binary, cache_dir, trace,
+                               timeout, audio_formats)
+                   for name in file_names]
+        results = [future.result() for future in futures]
+
+    write_manifest(results, output_root)
+    return results
+
+
+def write_manifest(results, output_root):
+    """Writes a JSON manifest with totals and a CSV with one row per work."""
+    works = []
+    for result in results:
+        work = asdict(result)
+        work['work'] = os.path.basename(result.output_dir)
+        work['pages'] = len(result.sections)
+        works.append(work)
+
+    summary = {
+        'total_works': len(works),
+        'total_pages': sum(work['pages'] for work in works),
+        'bad_pages': sum(len(work['bad_pages']) for work in works),
+        'bad_works': sum(1 for work in works if work['bad_pages'] or work['error']),
+        'render_count': sum(work['render_count'] for work in works),
+        'seconds': sum(work['seconds'] for work in works),
+    }
+    with open(os.path.join(output_root, 'manifest.json'), 'w', encoding='UTF-8') as f:
+        json.dump({'summary': summary, 'works': works}, f, indent=2)
+
+    columns = ['work', 'file_path', 'output_dir', 'pages', 'page_number', 'bad_pages', 'render_count', 'seconds',
+               'error']
+    with open(os.path.join(output_root, 'manifest.csv'), 'w', encoding='UTF-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for work in works:
+            writer.writerow(dict(work, bad_pages=len(work['bad_pages'])))
+    logger.info("Batch summary: %s", summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split every MusicXML score in a directory.')
+    parser.add_argument('input_dir', nargs='?', default='example')
+    parser.add_argument('--output', default='split_musicxml')
+    parser.add_argument('--mode', choices=sorted(SPLITTERS), default='split')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--renderer', default=None, help='renderer binary, defaults to the mode\'s MuseScore')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--trace', action='store_true', help='write a per-work trace.json with phase timings')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds per converted file before a renderer run is killed')
+    parser.add_argument('--audio', nargs='*', default=[], help='audio formats to export every section to, e.g. wav mp3')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(processName)s %(message)s')
+    binary = shlex.split(args.renderer) if args.renderer else None
+    run_batch(args.input_dir, args.output, args.mode, args.workers, binary, args.cache_dir, trace=args.trace,
+              timeout=args.timeout, audio_formats=args.audio)
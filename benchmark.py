@@ -0,0 +1,256 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import iterative_split
+import split
+import xmlbackend
+from instrument import Trace
+from render import AsyncRenderer
+
+
+STUB_RENDERER = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_renderer.py')]
+STEPS = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
+
+
+def synthetic_score(measure_count, part_count, measures_per_page=16, seed=0):
+    """
+    Builds a synthetic MusicXML score with varied notes, chords, lyrics, dynamics and key and
+    time changes, and an original page break every measures_per_page measures.
+    """
+    rng = random.Random(seed)
+    root = ET.Element('score-partwise', version='3.1')
+    defaults = ET.SubElement(root, 'defaults')
+    page_layout = ET.SubElement(defaults, 'page-layout')
+    ET.SubElement(page_layout, 'page-height').text = '1683'
+    ET.SubElement(page_layout, 'page-width').text = '1190'
+    part_list = ET.SubElement(root, 'part-list')
+    for part_number in range(1, part_count + 1):
+        score_part = ET.SubElement(part_list, 'score-part', id=f'P{part_number}')
+        ET.SubElement(score_part, 'part-name').text = f'Part {part_number}'
+
+    for part_number in range(1, part_count + 1):
+        part = ET.SubElement(root, 'part', id=f'P{part_number}')
+        for number in range(1, measure_count + 1):
+            measure = ET.SubElement(part, 'measure', number=str(number))
+            if number > 1 and (number - 1) % measures_per_page == 0:
+                ET.SubElement(measure, 'print', {'new-page': 'yes'})
+            if number == 1 or rng.random() < 0.03:
+                attributes = ET.SubElement(measure, 'attributes')
+                ET.SubElement(attributes, 'divisions').text = '4'
+                key = ET.SubElement(attributes, 'key')
+                ET.SubElement(key, 'fifths').text = str(rng.randint(-4, 4))
+                time_signature = ET.SubElement(attributes, 'time')
+                ET.SubElement(time_signature, 'beats').text = '4'
+                ET.SubElement(time_signature, 'beat-type').text = '4'
+                clef = ET.SubElement(attributes, 'clef', number='1')
+                ET.SubElement(clef, 'sign').text = 'G'
+                ET.SubElement(clef, 'line').text = '2'
+            if number == 1 or rng.random() < 0.05:
+                direction = ET.SubElement(measure, 'direction')
+                dynamics = ET.SubElement(ET.SubElement(direction, 'direction-type'), 'dynamics')
+                ET.SubElement(dynamics, rng.choice(['p', 'mf', 'f']))
+                ET.SubElement(direction, 'sound', tempo=str(rng.choice([60, 90, 120])))
+            remaining = 16
+            while remaining:
+                duration = min(remaining, rng.choice([1, 2, 4, 4, 8]))
+                for chord_note in range(rng.choice([1, 1, 1, 2, 3])):
+                    note = ET.SubElement(measure, 'note')
+                    if chord_note:
+                        ET.SubElement(note, 'chord')
+                    pitch = ET.SubElement(note, 'pitch')
+                    ET.SubElement(pitch, 'step').text = rng.choice(STEPS)
+                    if rng.random() < 0.1:
+                        ET.SubElement(pitch, 'alter').text = '1'
+                    ET.SubElement(pitch, 'octave').text = str(rng.randint(3, 5))
+                    ET.SubElement(note, 'duration').text = str(duration)
+                    if not chord_note and rng.random() < 0.2:
+                        ET.SubElement(ET.SubElement(note, 'lyric'), 'text').text = 'la'
+                remaining -= duration
+    return ET.ElementTree(root)
+
+
+def _bytes_written():
+    """Returns the bytes this process has written so far, from /proc where available."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_kb():
+    """
+    Returns the peak resident set size of this process in KB. /proc's VmHWM starts afresh when a
+    process is spawned, while ru_maxrss keeps the peak of the parent it was forked from.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _output_digest(output_dir):
+    """
+    Returns a SHA-256 digest of the names and bytes of every XML document in output_dir, except
+    the padded _tmp3 section renders, which part-parallel splits keep in their scratch directories.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.xml') and not name.endswith('_tmp3.xml'):
+            digest.update(name.encode('UTF-8') + b'\0')
+            with open(os.path.join(output_dir, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def run_case(splitter, score_path, measure_count, part_count, measures_per_page=16, workers=1, search=None,
+             part_workers=1):
+    """
+    Splits a synthetic score written to score_path with the stub renderer and returns its
+    measurements. Meant to run in a fresh process that did not build the score, so that peak RSS
+    belongs to the split alone.
+    """
+    work_dir = tempfile.mkdtemp(prefix='split_benchmark_')
+    try:
+        output_dir = os.path.join(work_dir, 'output')
+        os.environ['STUB_MEASURES_PER_PAGE'] = str(measures_per_page)
+
+        renderer = AsyncRenderer(STUB_RENDERER, workers=workers, trace=Trace())
+        bytes_before = _bytes_written()
+        start = time.perf_counter()
+        if splitter == 'iterative':
+            result = iterative_split.split_musicxml_by_page(score_path, output_dir, renderer=renderer,
+                                                            workers=workers, search=search, part_workers=part_workers)
+        else:
+            result = split.split_musicxml_by_page(score_path, output_dir, renderer=renderer,
+                                                  streaming=search == 'streaming', render_once=search == 'render_once',
+                                                  part_workers=part_workers)
+        wall_time = time.perf_counter() - start
+        renderer.close()
+
+        bytes_after = _bytes_written()
+        if bytes_after is None:
+            bytes_written = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir))
+        else:
+            bytes_written = bytes_after - bytes_before
+        sections = len(result.sections) or 1
+        return {
+            'xml_backend': xmlbackend.BACKEND,
+            'splitter': splitter,
+            'search': search,
+            'measures': measure_count,
+            'parts': part_count,
+            'workers': workers,
+            'part_workers': part_workers,
+            'wall_time': wall_time,
+            'sections': len(result.sections),
+            'renders': result.render_count,
+            'renders_per_section': result.render_count / sections,
+            'bytes_written': bytes_written,
+            'peak_rss_kb': _peak_rss_kb(),
+            'serialization_time': result.trace['phases'].get('serialize', {}).get('seconds', 0.0),
+            'phases': result.trace['phases'],
+            'output_digest': _output_digest(output_dir),
+            'error': result.error,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmarks(splitters, measure_counts, part_counts, measures_per_page=16, workers=1, search=None,
+                   xml_backends=(None,), part_workers=1):
+    """
+    Runs every combination of splitter, measure count, part count and XML backend, each in its own
+    process. When several backends are given, reports whether each case wrote byte-identical XML under all
+    of them.
+    """
+    results = []
+    score_dir = tempfile.mkdtemp(prefix='split_benchmark_scores_')
+    try:
+        # Built here, so that the construction of a score does not count towards a case's peak RSS
+        score_paths = {}
+        for measure_count in measure_counts:
+            for part_count in part_counts:
+                score_path = os.path.join(score_dir, f'score_{measure_count}_{part_count}.musicxml')
+                synthetic_score(measure_count, part_count, measures_per_page).write(score_path, encoding='UTF-8',
+                                                                                    xml_declaration=True)
+                score_paths[measure_count, part_count] = score_path
+
+        for splitter in splitters:
+            for measure_count in measure_counts:
+                for part_count in part_counts:
+                    digests = set()
+                    for xml_backend in xml_backends:
+                        case = _run_case_process(xml_backend, splitter, score_paths[measure_count, part_count],
+                                                 measure_count, part_count, measures_per_page, workers, search,
+                                                 part_workers)
+                        print(f"{splitter:>9} {measure_count:>5} measures {part_count:>2} parts "
+                              f"{case['xml_backend']:>5}: {case['wall_time']:8.2f}s "
+                              f"{case['renders_per_section']:5.2f} renders/section "
+                              f"{case['bytes_written'] / 1e6:8.2f} MB written "
+                              f"{case['peak_rss_kb'] / 1024:7.1f} MB peak RSS "
+                              f"{case['serialization_time']:7.2f}s serializing", flush=True)
+                        digests.add(case['output_digest'])
+                        results.append(case)
+                    if len(xml_backends) > 1:
+                        print(f"{splitter:>9} {measure_count:>5} measures {part_count:>2} parts: XML output "
+                              f"{'identical' if len(digests) == 1 else 'DIFFERS'} across backends", flush=True)
+    finally:
+        shutil.rmtree(score_dir, ignore_errors=True)
+    return results
+
+
+def _run_case_process(xml_backend, *args):
+    """Runs run_case in a fresh spawned process under the given XML backend, or the default one."""
+    previous_backend = os.environ.get('SPLIT_SCORES_XML_BACKEND')
+    if xml_backend is not None:
+        # spawned workers import xmlbackend afresh and pick the backend up from the environment
+        os.environ['SPLIT_SCORES_XML_BACKEND'] = xml_backend
+    try:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            return pool.submit(run_case, *args).result()
+    finally:
+        if previous_backend is None:
+            os.environ.pop('SPLIT_SCORES_XML_BACKEND', None)
+        else:
+            os.environ['SPLIT_SCORES_XML_BACKEND'] = previous_backend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the splitters on synthetic scores with a stub renderer.')
+    parser.add_argument('--splitter', nargs='+', choices=['iterative', 'split'], default=['iterative', 'split'])
+    parser.add_argument('--measures', nargs='+', type=int, default=[50, 500],
+                        help='measure counts, e.g. 50 500 5000')
+    parser.add_argument('--parts', nargs='+', type=int, default=[1, 4], help='part counts, e.g. 1 4 20')
+    parser.add_argument('--measures-per-page', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--part-workers', type=int, default=1, help='parts split at the same time')
+    parser.add_argument('--search', default=None,
+                        help="iterative search strategy, or 'streaming' or 'render_once' for split.py's modes")
+    parser.add_argument('--xml-backend', nargs='+', choices=['lxml', 'etree'], default=[None],
+                        help='XML backends to run each case under, e.g. lxml etree to compare their outputs')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+    args = parser.parse_args()
+    benchmark_results = run_benchmarks(args.splitter, args.measures, args.parts, args.measures_per_page,
+                                       args.workers, args.search, args.xml_backend, args.part_workers)
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as f:
+            json.dump(benchmark_results, f, indent=2)
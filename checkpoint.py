@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+def file_hash(file_path):
+    """Returns the SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(data):
+    """Returns a short fingerprint of bytes, e.g. a serialized measure."""
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def outputs_intact(directory, section):
+    """Checks that every output file of a recorded section is in directory with its recorded contents."""
+    for name, digest in section['outputs'].items():
+        file_path = os.path.join(directory, name)
+        if not os.path.exists(file_path) or file_hash(file_path) != digest:
+            return False
+    return True
+
+
+class Checkpoint:
+    """
+    Records the completed sections of one part of a score, so that an interrupted split can
+    resume after the last section whose outputs are intact.
+
+    The checkpoint lives in <output_dir>/checkpoint_<part_id>.json and holds the hash of the
+    score plus, per section, its page number, first measure index, fit and the hashes of its
+    output files. A checkpoint written for other score contents is ignored, but kept as
+    previous for an incremental split (see PreviousPlan). For that, the split also records the
+    fingerprints of the part's measures and of the document header, and of every section's
+    carry state. Every update is written atomically.
+
+    Once an incremental split has moved the previous outputs aside (stashed is set), the
+    previous plan is saved with the checkpoint until finish() is called, so that a split
+    interrupted after its first new section can still reuse it when it is resumed.
+    """
+
+    def __init__(self, output_dir, part_id, score_hash):
+        self.output_dir = output_dir
+        self.part_id = part_id
+        self.score_hash = score_hash
+        self.path = os.path.join(output_dir, f'checkpoint_{part_id}.json')
+        self.stash_dir = os.path.join(output_dir, f'previous_{part_id}')
+        self.sections = []
+        self.previous = None
+        self.stashed = False
+        self.fingerprints = None
+        self.header = None
+        try:
+            with open(self.path, encoding='UTF-8') as f:
+                data = json.load(f)
+            if data.get('part_id') == part_id:
+                if data.get('score_hash') == score_hash:
+                    self.sections = data['sections']
+                    # The plan of an unfinished incremental split, whose outputs are in the stash
+                    self.previous = data.get('previous')
+                    self.stashed = self.previous is not None
+                else:
+                    self.previous = {key: value for key, value in data.items() if key != 'previous'}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _intact(self, section):
+        """Checks that every output file of a section still has its recorded contents."""
+        return outputs_intact(self.output_dir, section)
+
+    def keepable(self, page_number, measure_index=0):
+        """
+        Returns, without changing the checkpoint, the run of consecutive sections that starts at
+        page_number and measure_index and whose outputs are intact.
+        """
+        kept = []
+        for section in self.sections:
+            if (section['page_number'] != page_number or section['measure_index'] != measure_index
+                    or not self._intact(section)):
+                break
+            kept.append(section)
+            page_number += 1
+            measure_index += section['best_fit']
+        return kept
+
+    def resume(self, page_number, measure_index=0):
+        """
+        Returns the recorded sections that can be kept (see keepable). Everything after them is
+        dropped from the checkpoint, as it has to be split again.
+        """
+        kept = self.keepable(page_number, measure_index)
+        if len(kept) != len(self.sections):
+            self.sections = kept
+            self.save()
+        return kept
+
+    def add(self, page_number, measure_index, best_fit, output_paths, state=None):
+        """Records a completed section, the output files it wrote and the fingerprint of its carry state."""
+        outputs = {os.path.basename(file_path): file_hash(file_path)
+                   for file_path in output_paths if os.path.exists(file_path)}
+        section = {'page_number': page_number, 'measure_index': measure_index, 'best_fit': best_fit,
+                   'outputs': outputs}
+        if state is not None:
+            section['state'] = state
+        self.sections.append(section)
+        self.save()
+
+    def save(self):
+        """Writes the checkpoint atomically."""
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            data = {'score_hash': self.score_hash, 'part_id': self.part_id, 'sections': self.sections}
+            if self.fingerprints is not None:
+                data.update(header=self.header, fingerprints=self.fingerprints)
+            if self.stashed:
+                data['previous'] = self.previous
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        """Drops the previous plan once the part is split, and removes the outputs moved aside for it."""
+        if self.stashed:
+            self.previous = None
+            self.stashed = False
+            self.save()
+        shutil.rmtree(self.stash_dir, ignore_errors=True)
+
+
+class PreviousPlan:
+    """
+    The sections that a split of an earlier version of a score recorded for one part, matched
+    against the measure fingerprints of the current version, so that an incremental split only
+    searches the sections an edit affects.
+
+    Sections before the first changed measure are kept, as long as the measure after each of
+    them, whose overflow ended it, is unchanged too. Past the change the search resumes, and a
+    section boundary in the unchanged tail of the part that starts a previous section with the
+    same carry state lines the plan up again: that section and all after it are reused. Nothing
+    is reused if the document header changed.
+
+    The outputs of the previous sections are moved aside to <output_dir>/previous_<part_id>, so
+    that the sections searched again never overwrite them, unless stashed says an interrupted
+    split already did; restore() moves a reused section's outputs back under its new page
+    number and Checkpoint.finish() removes the rest.
+    """
+
+    def __init__(self, data, output_dir, part_id, fingerprints, header, stashed=False):
+        self.output_dir = output_dir
+        self.part_id = part_id
+        self.stash_dir = os.path.join(output_dir, f'previous_{part_id}')
+        previous = data.get('fingerprints') or []
+        self.sections = data['sections'] if previous and data.get('header') == header else []
+
+        common = min(len(previous), len(fingerprints))
+        prefix = 0
+        while prefix < common and previous[prefix] == fingerprints[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < common - prefix and previous[-1 - suffix] == fingerprints[-1 - suffix]:
+            suffix += 1
+        self.identical = prefix == len(previous) == len(fingerprints)
+        self.first_changed = prefix
+        # Measure i of the tail, from tail_start on, is measure i + offset of the previous version
+        self.tail_start = len(fingerprints) - suffix
+        self.offset = len(previous) - len(fingerprints)
+
+        if stashed:
+            os.makedirs(self.stash_dir, exist_ok=True)
+            return
+        shutil.rmtree(self.stash_dir, ignore_errors=True)
+        os.makedirs(self.stash_dir)
+        for section in self.sections:
+            for name in section['outputs']:
+                if os.path.exists(os.path.join(output_dir, name)):
+                    os.replace(os.path.join(output_dir, name), os.path.join(self.stash_dir, name))
+
+    def prefix(self):
+        """Returns the previous sections from the start of the part that can be kept."""
+        kept = []
+        measure_index = 0
+        for section in self.sections:
+            end = section['measure_index'] + section['best_fit']
+            if (section['measure_index'] != measure_index or not (self.identical or end < self.first_changed)
+                    or not outputs_intact(self.stash_dir, section)):
+                break
+            kept.append(section)
+            measure_index = end
+        return kept
+
+    def aligned(self, measure_index, state):
+        """
+        Returns the previous sections that can be reused from a section boundary at measure_index
+        with the given carry-state fingerprint on, or an empty list if the plans do not line up there.
+        """
+        if measure_index < self.tail_start:
+            return []
+        for number, section in enumerate(self.sections):
+            if section['measure_index'] == measure_index + self.offset and section.get('state') == state:
+                reused = self.sections[number:]
+                if all(outputs_intact(self.stash_dir, section) for section in reused):
+                    return reused
+                return []
+        return []
+
+    def restore(self, section, page_number):
+        """Moves the outputs of a reused section back, renamed for page_number. Returns their paths."""
+        output_paths = []
+        for name in section['outputs']:
+            file_path = os.path.join(self.output_dir,
+                                     f"section_{page_number}_part_{self.part_id}{os.path.splitext(name)[1]}")
+            os.replace(os.path.join(self.stash_dir, name), file_path)
+            output_paths.append(file_path)
+        return output_paths
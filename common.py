@@ -1,27 +1,59 @@
-import xml.etree.ElementTree as ET
+import logging
+from collections import namedtuple
+from dataclasses import dataclass, field
 
+from score_index import index_measures
+from xmlbackend import ET, shared, tostring
 
-def find_last_tempo_and_dynamics(measures):
+
+logger = logging.getLogger(__name__)
+
+
+# The attributes in effect at a measure, as carried over from all the measures before it.
+# clefs maps a clef number attribute (None for single-staff parts) to its clef element.
+CarryState = namedtuple('CarryState', ['tempo', 'dynamic', 'key', 'time', 'clefs', 'divisions'])
+EMPTY_CARRY_STATE = CarryState(None, None, None, None, {}, None)
+
+
+@dataclass
+class SplitResult:
+    """
+    The outcome of splitting one score. page_number is the next free page number, as returned
+    by the splitters before results were introduced; sections holds one dict per saved section.
+    """
+    file_path: str
+    output_dir: str
+    page_number: int = 1
+    sections: list = field(default_factory=list)
+    bad_pages: list = field(default_factory=list)
+    render_count: int = 0
+    seconds: float = 0.0
+    error: str = None
+    trace: dict = None
+
+
+def _records(measures, records):
+    """
+    Returns the MeasureRecords the find_last_* helpers walk: records, if the caller already
+    indexed the measures, e.g. once per part, or else those of measures.
+    """
+    return index_measures(measures) if records is None else records
+
+
+def find_last_tempo_and_dynamics(measures, records=None):
     """
     Finds the last tempo and dynamic markings within a list of measures.
     """
     last_tempo = None
     last_dynamic = None
 
-    for measure in measures:
-        # Find the tempo in the measure
-        for direction in measure.findall('direction'):
-            sound = direction.find('sound')
-            if sound is not None and 'tempo' in sound.attrib:
-                last_tempo = float(sound.get('tempo'))
-                print(f"Tempo found in measure {measure.get('number')}: {last_tempo}")
-
-        # Find the dynamic markings in the measure
-        for direction in measure.findall('direction'):
-            dynamics = direction.find('direction-type/dynamics')
-            if dynamics is not None and len(dynamics) > 0:
-                last_dynamic = dynamics[0].tag
-                print(f"Dynamic found in measure {measure.get('number')}: {last_dynamic}")
+    for record in _records(measures, records):
+        if record.tempo is not None:
+            last_tempo = record.tempo
+            logger.debug("Tempo found in measure %s: %s", record.number, last_tempo)
+        if record.dynamic is not None:
+            last_dynamic = record.dynamic
+            logger.debug("Dynamic found in measure %s: %s", record.number, last_dynamic)
 
     return last_tempo, last_dynamic
 
@@ -45,23 +77,20 @@ def add_tempo_and_dynamics(measure, last_tempo, last_dynamic):
         direction_type = ET.SubElement(direction, 'direction-type')
         dynamics = ET.SubElement(direction_type, 'dynamics')
         dynamic = ET.SubElement(dynamics, last_dynamic)
-        dynamic.text = ''  # Text is not usually used, but ensure node exists
         measure.insert(0, direction)  # Insert at the start of the measure
 
 
-def find_last_key(measures):
+def find_last_key(measures, records=None):
     """
     Finds the last key signature in the given measures.
     """
     last_key = None
 
-    for measure in measures:
-        attributes = measure.find('attributes')
-        if attributes is not None:
-            key = attributes.find('key')
-            if key is not None:
-                last_key = key
-                print(f"Key signature found in measure {measure.get('number')}: {ET.tostring(key)}")
+    for record in _records(measures, records):
+        if record.key is not None:
+            last_key = record.key
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Key signature found in measure %s: %s", record.number, ET.tostring(last_key))
 
     return last_key
 
@@ -79,22 +108,20 @@ def add_key_signature(measure, last_key):
         existing_key = attributes.find('key')
         # if there is not key signature Add the last known key signature
         if existing_key is None:
-            attributes.append(last_key)
+            attributes.append(shared(last_key))
 
 
-def find_last_time(measures):
+def find_last_time(measures, records=None):
     """
     Finds the last time signature in the given measures.
     """
     last_time = None
 
-    for measure in measures:
-        attributes = measure.find('attributes')
-        if attributes is not None:
-            time = attributes.find('time')
-            if time is not None:
-                last_time = time
-                print(f"Time signature found in measure {measure.get('number')}: {ET.tostring(time)}")
+    for record in _records(measures, records):
+        if record.time is not None:
+            last_time = record.time
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Time signature found in measure %s: %s", record.number, ET.tostring(last_time))
 
     return last_time
 
@@ -112,23 +139,21 @@ def add_time_signature(measure, last_time):
         # if there is not time signature Add the last known time signature
         existing_time = attributes.find('time')
         if existing_time is None:
-            attributes.append(last_time)
+            attributes.append(shared(last_time))
 
 
-def find_last_clef(measures, clef_number):
+def find_last_clef(measures, clef_number, records=None):
     """
     Finds the last clef in the given measures with a specific clef number.
     """
     last_clef = None
 
-    for measure in measures:
-        attributes = measure.find('attributes')
-        if attributes is not None:
-            clefs = attributes.findall('clef')
-            for clef in clefs:
-                if clef.get('number') == str(clef_number):
-                    last_clef = clef
-                    print(f"Clef {clef_number} found in measure {measure.get('number')}: {ET.tostring(clef)}")
+    for record in _records(measures, records):
+        for number, clef in record.clefs:
+            if number == str(clef_number):
+                last_clef = clef
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Clef %s found in measure %s: %s", clef_number, record.number, ET.tostring(clef))
 
     return last_clef
 
@@ -153,22 +178,20 @@ def add_clef(measure, last_clef):
 
         # If the clef does not exist, add the last known clef
         if existing_clef is None:
-            attributes.append(last_clef)
+            attributes.append(shared(last_clef))
 
 
-def find_last_divisions(measures):
+def find_last_divisions(measures, records=None):
     """
     Finds the last divisions in the given measures.
     """
     last_divisions = None
 
-    for measure in measures:
-        attributes = measure.find('attributes')
-        if attributes is not None:
-            divisions = attributes.find('divisions')
-            if divisions is not None:
-                last_divisions = divisions
-                print(f"Divisions found in measure {measure.get('number')}: {ET.tostring(divisions)}")
+    for record in _records(measures, records):
+        if record.divisions is not None:
+            last_divisions = record.divisions
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Divisions found in measure %s: %s", record.number, ET.tostring(last_divisions))
 
     return last_divisions
 
@@ -186,7 +209,7 @@ def add_divisions(measure, last_divisions):
         # if there is not divisions Add the last known divisions
         existing_divisions = attributes.find('divisions')
         if existing_divisions is None:
-            attributes.insert(0, last_divisions)
+            attributes.insert(0, shared(last_divisions))
 
 
 def add_final_barline(measure):
@@ -204,7 +227,7 @@ def copy_metadata_sections(source_root, target_root):
     """
     for child in source_root:
         if child.tag in [ 'defaults', 'part-list']: #, 'credit' 'identification',
-            target_root.append(child)
+            target_root.append(shared(child))
 
 def copy_metadata_sections_all(source_root, target_root):
     """
@@ -212,24 +235,77 @@ def copy_metadata_sections_all(source_root, target_root):
     """
     for child in source_root:
         if child.tag in [ 'defaults', 'part-list', 'credit' 'identification',]: #, 'credit' 'identification',
-            target_root.append(child)
+            target_root.append(shared(child))
+
+
+def advance_carry_state(state, record):
+    """
+    Returns the carry state in effect after a measure, given as its score_index.MeasureRecord,
+    starting from the given state.
+    """
+    tempo, dynamic, key, time, clefs, divisions = state
+
+    if record.tempo is not None:
+        tempo = record.tempo
+    if record.dynamic is not None:
+        dynamic = record.dynamic
+    if record.key is not None:
+        key = record.key
+    if record.time is not None:
+        time = record.time
+    if record.divisions is not None:
+        divisions = record.divisions
+    if record.clefs:
+        clefs = dict(clefs)
+        clefs.update(record.clefs)
+
+    return CarryState(tempo, dynamic, key, time, clefs, divisions)
+
+
+def build_carry_state_index(records):
+    """
+    Builds the carry state index of a part in a single pass over its measure records.
+    index[i] is the state carried into measure i, i.e. the state after measures [0, i),
+    so the attributes a section starting at measure i needs are an O(1) lookup.
+    The index has len(records) + 1 entries; the last one is the state at the end of the part.
+    """
+    index = [EMPTY_CARRY_STATE]
+    for record in records:
+        index.append(advance_carry_state(index[-1], record))
+    return index
+
+
+def add_carry_state(measure, state):
+    """
+    Adds the attributes of a carry state to the beginning of the given measure.
+    """
+    add_divisions(measure, state.divisions)
+    add_tempo_and_dynamics(measure, state.tempo, state.dynamic)
+    add_key_signature(measure, state.key)
+    add_time_signature(measure, state.time)
+    for clef_number in sorted(state.clefs, key=str):
+        add_clef(measure, state.clefs[clef_number])
+
+
+def carry_state_bytes(state):
+    """
+    Serializes a carry state, e.g. to fingerprint it: two states with the same bytes add the
+    same attributes to a measure.
+    """
+    clef_numbers = sorted(state.clefs, key=str)
+    elements = [state.key, state.time, state.divisions] + [state.clefs[number] for number in clef_numbers]
+    return repr((state.tempo, state.dynamic, clef_numbers)).encode('UTF-8') + b'\0'.join(
+        b'' if element is None else tostring(element) for element in elements)
 
 
-def find_and_add_last_attributes(current_measure, previous_measures):
+def find_and_add_last_attributes(current_measure, previous_measures, records=None):
     """
     Finds the last attributes in the previous measures and adds them to the current measure.
+    Prefer build_carry_state_index and add_carry_state when attributes are needed for many measures.
     """
-    last_tempo, last_dynamic = find_last_tempo_and_dynamics(previous_measures)
-    last_key = find_last_key(previous_measures)
-    last_time = find_last_time(previous_measures)
-    last_clef_right = find_last_clef(previous_measures, 1)
-    last_clef_left = find_last_clef(previous_measures, 2)
-    last_divisions = find_last_divisions(previous_measures)
-
-    add_divisions(current_measure, last_divisions)
-    add_tempo_and_dynamics(current_measure, last_tempo, last_dynamic)
-    add_key_signature(current_measure, last_key)
-    add_time_signature(current_measure, last_time)
-    add_clef(current_measure, last_clef_right)
-    add_clef(current_measure, last_clef_left)
-    return last_tempo, last_dynamic, last_key, last_time, last_clef_right, last_clef_left, last_divisions
\ No newline at end of file
+    state = EMPTY_CARRY_STATE
+    for record in _records(previous_measures, records):
+        state = advance_carry_state(state, record)
+    add_carry_state(current_measure, state)
+    return (state.tempo, state.dynamic, state.key, state.time, state.clefs.get('1'), state.clefs.get('2'),
+            state.divisions)
@@ -0,0 +1,322 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import shlex
+import signal
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import split
+from common import SplitResult
+from instrument import NULL_TRACE, Trace
+from render import AsyncRenderer
+from render_cache import RenderCache
+from xmlbackend import ET
+
+
+logger = logging.getLogger(__name__)
+
+
+class Draining(RuntimeError):
+    """Raised when a job is submitted to a daemon that is shutting down."""
+
+
+@dataclass
+class SplitJob:
+    """One request to split a score with split.split_musicxml_by_page, and its outcome."""
+    job_id: int
+    file_path: str
+    output_dir: str
+    render_once: bool = False
+    status: str = 'queued'
+    submitted: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+    result: dict = None
+
+    def to_dict(self):
+        return asdict(self)
+
+
+class ScoreCache:
+    """
+    The split.ParsedScores of the most recently split scores, keyed by path, modification time
+    and size so that an edited file is parsed again. Splitting does not modify a ParsedScore, so
+    jobs on the same score share one. A score is parsed once even when several jobs ask for it
+    at the same time: the later ones wait for the first one's parse and count as hits.
+    """
+
+    def __init__(self, max_scores=16):
+        self.max_scores = max_scores
+        self.hits = 0
+        self.misses = 0
+        # Futures of the ParsedScores, so that a score being parsed is already in the cache
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_path, trace=NULL_TRACE):
+        """Returns the ParsedScore of a file, parsing it on a miss. Raises OSError and ET.ParseError."""
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            score = self._scores.get(key)
+            if score is not None:
+                self._scores.move_to_end(key)
+                self.hits += 1
+                return score.result()
+            self.misses += 1
+            score = self._scores[key] = Future()
+            while len(self._scores) > self.max_scores:
+                self._scores.popitem(last=False)
+        try:
+            score.set_result(split.parse_score(file_path, trace))
+        except BaseException as e:
+            # Waiting jobs get the error too, later ones try again
+            score.set_exception(e)
+            with self._lock:
+                if self._scores.get(key) is score:
+                    del self._scores[key]
+        return score.result()
+
+
+class SplitDaemon:
+    """
+    A long-running split service. Jobs are queued with submit() and run by `workers` threads,
+    each with its own AsyncRenderer that stays warm across jobs: the renderer version is looked
+    up once and, with cache_dir, renders are shared through one RenderCache. Parsed scores and
+    their carry-state indexes are kept in a ScoreCache. The last `history` jobs can be looked up
+    in jobs by ID.
+
+    shutdown() drains the daemon: new jobs are refused with Draining while the queued and running
+    ones finish. serve() exposes the daemon over localhost HTTP (see DaemonRequestHandler).
+    """
+
+    def __init__(self, binary='mscore3', workers=1, cache_dir=None, timeout=300, max_scores=16, trace=False,
+                 latency_window=1000, history=10000):
+        self.cache = RenderCache(cache_dir) if cache_dir else None
+        self.renderers = [AsyncRenderer(binary, cache=self.cache, timeout=timeout) for _ in range(max(1, workers))]
+        self.scores = ScoreCache(max_scores)
+        self.trace = trace
+        self.history = history
+        self.jobs = {}
+        self.completed = 0
+        self.failed = 0
+        self.render_count = 0
+        self.started = time.time()
+        self._job_ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=latency_window)
+        self._waits = deque(maxlen=latency_window)
+        self._draining = False
+        self._lock = threading.Lock()
+        self._server = None
+        self._threads = [threading.Thread(target=self._work, args=(renderer,), name=f'split-worker-{number}',
+                                          daemon=True)
+                         for number, renderer in enumerate(self.renderers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, file_path, output_dir, render_once=False):
+        """Queues a split and returns its SplitJob. Raises Draining once shutdown() has been called."""
+        with self._lock:
+            if self._draining:
+                raise Draining("The daemon is shutting down")
+            job = SplitJob(next(self._job_ids), file_path, output_dir, render_once)
+            self.jobs[job.job_id] = job
+            self._queue.put(job)
+        return job
+
+    def _work(self, renderer):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                self._run(job, renderer)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job, renderer):
+        job.status = 'running'
+        job.started = time.time()
+        trace = Trace() if self.trace else NULL_TRACE
+        # The renderer is reused, so it reports to the trace of the job at hand only
+        renderer.trace = trace
+        try:
+            score = self.scores.get(job.file_path, trace)
+            result = split.split_musicxml_by_page(job.file_path, job.output_dir, renderer=renderer, trace=trace,
+                                                  render_once=job.render_once, score=score)
+        except ET.ParseError as e:
+            result = SplitResult(job.file_path, job.output_dir, error=f"Error parsing MusicXML file: {e}")
+        except Exception as e:
+            result = SplitResult(job.file_path, job.output_dir, error=f"{type(e).__name__}: {e}")
+            traceback.print_exc()
+        finally:
+            renderer.trace = NULL_TRACE
+        job.finished = time.time()
+        job.result = asdict(result)
+        job.status = 'failed' if result.error else 'done'
+        with self._lock:
+            if result.error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self.render_count += result.render_count
+            self._waits.append(job.started - job.submitted)
+            self._latencies.append(job.finished - job.submitted)
+            # Forget the oldest finished jobs beyond the history
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                del self.jobs[oldest.job_id]
+        logger.info("Job %s %s in %.2fs: %s", job.job_id, job.status, job.finished - job.submitted, job.file_path)
+
+    def metrics(self):
+        """Returns queue depth, job counts, throughput in jobs per second, and latency statistics."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            waits = sorted(self._waits)
+            statuses = [job.status for job in self.jobs.values()]
+            uptime = time.time() - self.started
+            finished = self.completed + self.failed
+            return {
+                'queue_depth': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'completed': self.completed,
+                'failed': self.failed,
+                'draining': self._draining,
+                'uptime': uptime,
+                'throughput': finished / uptime if uptime > 0 else 0.0,
+                'render_count': self.render_count,
+                'latency': _summary(latencies),
+                'queue_wait': _summary(waits),
+                'score_cache': {'hits': self.scores.hits, 'misses': self.scores.misses},
+            }
+
+    def wait(self):
+        """Blocks until every submitted job has finished."""
+        self._queue.join()
+
+    def shutdown(self):
+        """Refuses new jobs, lets the queued and running ones finish, then stops the workers and renderers."""
+        with self._lock:
+            if self._draining:
+                return
+            self._draining = True
+            for _ in self._threads:
+                self._queue.put(None)
+        logger.info("Draining %s queued jobs", self.metrics()['queue_depth'])
+        for thread in self._threads:
+            thread.join()
+        for renderer in self.renderers:
+            renderer.close()
+        if self._server is not None:
+            self._server.shutdown()
+
+    def serve(self, host='127.0.0.1', port=8765):
+        """Serves the daemon over HTTP until shutdown() is called, e.g. from a signal handler."""
+        self._server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+        self._server.split_daemon = self
+        logger.info("Listening on http://%s:%s", *self._server.server_address)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+
+def _summary(values):
+    """Returns the mean and the 50th, 95th and 99th percentiles of sorted values, in seconds."""
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        **{f'p{percentile}': values[min(len(values) - 1, len(values) * percentile // 100)]
+           for percentile in (50, 95, 99)},
+    }
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP interface of a SplitDaemon, which the server holds as its `split_daemon` attribute:
+    POST /jobs with a JSON object {"file_path": ..., "output_dir": ..., "render_once": false}
+    queues a split and answers 202 with the job; GET /jobs/<id> returns a job and its result once
+    it has one; GET /metrics returns SplitDaemon.metrics(); POST /shutdown drains the daemon.
+    While draining, new jobs are refused with 503.
+    """
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        daemon = self.server.split_daemon
+        if self.path == '/metrics':
+            self._reply(200, daemon.metrics())
+        elif self.path.startswith('/jobs/'):
+            try:
+                job = daemon.jobs[int(self.path[len('/jobs/'):])]
+            except (KeyError, ValueError):
+                self._reply(404, {'error': 'No such job'})
+                return
+            self._reply(200, job.to_dict())
+        else:
+            self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        daemon = self.server.split_daemon
+        if self.path == '/shutdown':
+            self._reply(202, {'draining': True})
+            threading.Thread(target=daemon.shutdown).start()
+        elif self.path == '/jobs':
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = daemon.submit(request['file_path'], request['output_dir'],
+                                    bool(request.get('render_once', False)))
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': f"Bad job: {e}"})
+                return
+            except Draining as e:
+                self._reply(503, {'error': str(e)})
+                return
+            self._reply(202, job.to_dict())
+        else:
+            self._reply(404, {'error': 'Not found'})
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve split.py jobs over localhost HTTP with warm caches.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--renderer', default=None, help='renderer binary, defaults to mscore3')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds per converted file before a renderer run is killed')
+    parser.add_argument('--max-scores', type=int, default=16, help='parsed scores kept in memory')
+    parser.add_argument('--trace', action='store_true', help='attach per-phase timings to every job result')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(threadName)s %(message)s')
+    split_daemon = SplitDaemon(shlex.split(args.renderer) if args.renderer else 'mscore3', args.workers,
+                               args.cache_dir, args.timeout, args.max_scores, args.trace)
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda *_: threading.Thread(target=split_daemon.shutdown).start())
+    split_daemon.serve(args.host, args.port)
@@ -0,0 +1,184 @@
+import math
+
+
+# Layout defaults in tenths, close to MuseScore's defaults for an A4 page
+DEFAULT_PAGE_WIDTH = 1190.0
+DEFAULT_PAGE_HEIGHT = 1683.0
+DEFAULT_MARGIN = 70.0
+DEFAULT_STAFF_DISTANCE = 65.0
+DEFAULT_SYSTEM_DISTANCE = 120.0
+STAFF_HEIGHT = 40.0
+
+# Horizontal engraving costs in tenths
+MEASURE_PADDING = 15.0
+QUARTER_NOTE_SPACE = 25.0
+MINIMUM_NOTE_SPACE = 12.0
+ACCIDENTAL_SPACE = 10.0
+LYRIC_CHARACTER_SPACE = 7.0
+CLEF_SPACE = 30.0
+KEY_ACCIDENTAL_SPACE = 10.0
+TIME_SPACE = 20.0
+SYSTEM_HEADER_SPACE = 50.0
+
+
+def _number(element, path, default):
+    """Returns the number at path below element, or default if it is missing or not a number."""
+    if element is None:
+        return default
+    text = element.findtext(path)
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return default
+
+
+def note_space(duration, divisions):
+    """Returns the horizontal space of a note or rest, growing with the log of its duration."""
+    quarters = duration / divisions if duration > 0 and divisions > 0 else 1.0
+    return max(MINIMUM_NOTE_SPACE, QUARTER_NOTE_SPACE * (1 + 0.6 * math.log2(quarters)))
+
+
+def _value(element, default):
+    """Returns the number in element's text, or default if element is None or its text is not a number."""
+    try:
+        return float(element.text)
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+
+def measure_width(record, divisions=1):
+    """
+    Estimates the horizontal width of a measure, given as its score_index.MeasureRecord, in
+    tenths from its contents: the longest voice of note and rest spaces, widened by accidentals
+    and lyrics, plus clef, key and time changes. Returns the width and the divisions in effect
+    at the end of the measure.
+    """
+    width = MEASURE_PADDING
+    divisions = _value(record.divisions, divisions)
+    if record.clefs:
+        width += CLEF_SPACE
+    if record.key is not None:
+        width += KEY_ACCIDENTAL_SPACE * max(1, abs(int(_number(record.key, 'fifths', 0))))
+    if record.time is not None:
+        width += TIME_SPACE
+    voices = {}
+    for voice, chord, duration, accidental, lyric_length in record.notes:
+        space = 0.0
+        if not chord:
+            space = note_space(divisions if duration is None else duration, divisions)
+        if accidental:
+            space += ACCIDENTAL_SPACE
+        space = max(space, LYRIC_CHARACTER_SPACE * lyric_length)
+        voices[voice] = voices.get(voice, 0.0) + space
+    return width + max(voices.values(), default=note_space(0, divisions)), divisions
+
+
+class PageGeometry:
+    """The usable system width and number of systems per page of a part, read from <defaults>."""
+
+    def __init__(self, root, staves=1):
+        defaults = root.find('defaults')
+        page_layout = defaults.find('page-layout') if defaults is not None else None
+        margins = page_layout.find('page-margins') if page_layout is not None else None
+        system_layout = defaults.find('system-layout') if defaults is not None else None
+
+        page_width = _number(page_layout, 'page-width', DEFAULT_PAGE_WIDTH)
+        page_height = _number(page_layout, 'page-height', DEFAULT_PAGE_HEIGHT)
+        left = _number(margins, 'left-margin', DEFAULT_MARGIN) + _number(system_layout, 'system-margins/left-margin', 0)
+        right = _number(margins, 'right-margin', DEFAULT_MARGIN) + _number(system_layout, 'system-margins/right-margin', 0)
+        top = _number(margins, 'top-margin', DEFAULT_MARGIN)
+        bottom = _number(margins, 'bottom-margin', DEFAULT_MARGIN)
+        staff_distance = _number(defaults, 'staff-layout/staff-distance', DEFAULT_STAFF_DISTANCE)
+        system_distance = _number(system_layout, 'system-distance', DEFAULT_SYSTEM_DISTANCE)
+
+        self.system_width = max(1.0, page_width - left - right - SYSTEM_HEADER_SPACE)
+        system_height = staves * STAFF_HEIGHT + (staves - 1) * staff_distance + system_distance
+        self.systems_per_page = max(1, int((page_height - top - bottom + system_distance) // system_height))
+
+    @property
+    def capacity(self):
+        """Returns the estimated width of measures a page holds."""
+        return self.system_width * self.systems_per_page
+
+
+class LayoutEstimator:
+    """
+    Predicts how many measures fit on a page without rendering.
+
+    Measure widths are estimated once per part and summed. The ratio between estimated and
+    rendered page capacity is calibrated per score from every section MuseScore lays out, the
+    first one included, and the spread of past prediction errors sets the width of the
+    predicted fit interval.
+    """
+
+    def __init__(self, root, tolerance=0.25):
+        self.root = root
+        self.tolerance = tolerance
+        self.scale = None
+        self.samples = 0
+        self.errors = []
+        self._parts = {}
+
+    def part_widths(self, part_id, records):
+        """
+        Returns the prefix sums of the estimated widths of a part's measures, given as their
+        score_index.MeasureRecords, and its geometry.
+        """
+        if part_id not in self._parts:
+            prefix = [0.0]
+            divisions = 1
+            staves = 1
+            for record in records:
+                staves = max(staves, int(_value(record.staves, staves)))
+                width, divisions = measure_width(record, divisions)
+                prefix.append(prefix[-1] + width)
+            self._parts[part_id] = (prefix, PageGeometry(self.root, staves))
+        return self._parts[part_id]
+
+    def _fit_for_width(self, prefix, start, width):
+        """Returns the largest count of measures from start whose estimated width is within width."""
+        low, high = 0, len(prefix) - 1 - start
+        while low < high:
+            mid = (low + high + 1) // 2
+            if prefix[start + mid] - prefix[start] <= width:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def predict(self, part_id, records, start):
+        """Returns the predicted number of measures that fit on a page starting at measure start."""
+        prefix, geometry = self.part_widths(part_id, records)
+        return self._fit_for_width(prefix, start, geometry.capacity * (self.scale or 1.0))
+
+    def fit_interval(self, part_id, records, start):
+        """
+        Returns a (low, high) interval expected to contain the fit of the page starting at
+        measure start. Before calibration the interval is wide; afterwards it is as wide as the
+        largest recent prediction error.
+        """
+        remaining = len(records) - start
+        prediction = self.predict(part_id, records, start)
+        if self.scale is None:
+            margin = max(2, math.ceil(prediction * 2 * self.tolerance))
+        elif not self.errors:
+            margin = math.ceil(prediction * self.tolerance / 4)
+        else:
+            margin = max(self.errors[-8:])
+        return max(1, min(prediction - margin, remaining)), max(1, min(prediction + margin, remaining))
+
+    def calibrate(self, part_id, records, start, fit):
+        """
+        Records the fit MuseScore found for the page starting at measure start. A fit that ends
+        the part is only a lower bound on the capacity and is not used.
+        """
+        prefix, geometry = self.part_widths(part_id, records)
+        if fit <= 0 or start + fit >= len(records):
+            return
+        if self.scale is not None:
+            self.errors.append(abs(self.predict(part_id, records, start) - fit))
+        # The page capacity lies between the width of the fit and the width of one more measure
+        used = (prefix[start + fit] + prefix[start + fit + 1]) / 2 - prefix[start]
+        self.samples += 1
+        sample = used / geometry.capacity
+        self.scale = sample if self.scale is None else self.scale + (sample - self.scale) / self.samples
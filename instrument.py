@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class _PhaseTimer:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Trace:
+    """
+    Collects per-phase timings and counters for one score.
+
+    Use `with trace.phase('render'):` around a phase and trace.count('renders') for events.
+    Every measurement is also passed to sink(kind, name, value), if given, with kind 'phase'
+    (value in seconds) or 'count'. Phases may nest, so their times need not add up to the total.
+    """
+    enabled = True
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        """Returns a context manager that times one run of a phase."""
+        return _PhaseTimer(self, name)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+        if self.sink is not None:
+            self.sink('phase', name, seconds)
+
+    def count(self, name, n=1):
+        """Adds n to a counter."""
+        with self._lock:
+            self.counters[name] += n
+        if self.sink is not None:
+            self.sink('count', name, n)
+
+    def to_dict(self):
+        """Returns the timings and counters as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                'wall_time': time.perf_counter() - self.started,
+                'phases': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds},
+                'counters': dict(self.counters),
+            }
+
+    def export(self, file_path):
+        """Writes the trace to a JSON file."""
+        with open(file_path, 'w', encoding='UTF-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class NullTrace:
+    """A disabled trace: timers and counters do nothing and cost a method call."""
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_TIMER
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def to_dict(self):
+        return None
+
+    def export(self, file_path):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+def attach_trace(renderer, trace=None):
+    """
+    Returns the trace a split should use: the given one, which the renderer then shares if it
+    has none of its own, or else the renderer's.
+    """
+    if trace is None:
+        return renderer.trace
+    if renderer.trace is NULL_TRACE:
+        renderer.trace = trace
+    return trace
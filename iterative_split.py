@@ -1,10 +1,31 @@
+import glob
+import logging
 import shutil
-import xml.etree.ElementTree as ET
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 from PyPDF2 import PdfReader, PdfWriter
 import xml.dom.minidom as minidom
 
-from common import find_and_add_last_attributes, copy_metadata_sections, add_final_barline, copy_metadata_sections_all
+from assembler import DocumentAssembler
+from checkpoint import Checkpoint, PreviousPlan, file_hash, fingerprint
+from instrument import NULL_TRACE, attach_trace
+from estimator import LayoutEstimator
+from planner import plan_sections
+from common import SplitResult, build_carry_state_index, add_carry_state, carry_state_bytes, add_final_barline
+from render import AsyncRenderer, pdf_page_count
+from render_cache import RenderCache
+from score_index import index_measures
+from search import binary_search_fit, kary_search_fit, galloping_search_fit, interval_search_fit
+from section_view import SectionView
+from xmlbackend import ET, parse, tostring
+
+
+logger = logging.getLogger(__name__)
+
+# A page section derived from a break-free layout; verify marks a boundary that may not hold in the section render
+LayoutSection = namedtuple('LayoutSection', ['measure_index', 'fit', 'verify'])
 
 
 def write_pretty_xml(element, file_path):
@@ -12,11 +33,14 @@ def write_pretty_xml(element, file_path):
     Writes an ElementTree to an XML file with pretty printing and correct indentation.
 
     Parameters:
-    element (ET.Element): The root element of the XML tree.
+    element (ET.Element or bytes): The root element of the XML tree, or a serialized document.
     file_path (str): The path to the file where the XML should be written.
     """
     # Convert the ElementTree element to a string
-    xml_string = ET.tostring(element, encoding='UTF-8', method='xml')
+    if isinstance(element, bytes):
+        xml_string = element
+    else:
+        xml_string = tostring(element)
 
     # Parse the string using minidom for pretty printing
     dom = minidom.parseString(xml_string)
@@ -50,146 +74,555 @@ def remove_page_and_system_breaks(root):
         if 'new-page' in print_element.attrib:
             del print_element.attrib['new-page']
 
-import xml.etree.ElementTree as ET
-import os
-import shutil
 
-def split_musicxml_by_page(file_path, output_dir='split_musicxml'):
+def split_musicxml_by_page(file_path, output_dir='split_musicxml', renderer=None, workers=1, search=None,
+                           pretty=False, trace=None, resume=True, audio=None, incremental=False, part_workers=1):
+    """
+    Splits a MusicXML file into one section per rendered page, part by part with split_part.
+
+    search names the page-fit strategy, one of 'binary', 'kary', 'gallop', 'estimate', 'layout'
+    and 'plan' (see split_part); it defaults to 'kary' with more than one worker and to 'binary'
+    otherwise. pretty=True pretty-prints the section files. Completed sections are checkpointed
+    in output_dir: resume=True keeps those of an earlier split of the same score, and
+    incremental=True also those an edit of the score does not affect. With an
+    audio.AudioExporter every section is exported to audio while the split goes on. With
+    part_workers > 1 the parts are split at the same time (see split_parts_concurrently).
+
+    Returns a SplitResult listing the part, page number, first measure index, fit and renders of
+    every section, and the per-phase timings and counters of an instrument.Trace, if one is given.
+    """
+    if search is None:
+        search = 'kary' if workers > 1 else 'binary'
+    if renderer is None:
+        renderer = AsyncRenderer('musescore-portable-nightly', workers=workers)
+    trace = attach_trace(renderer, trace)
+
+    result = SplitResult(file_path, output_dir)
+    start_time = time.perf_counter()
+    renders_at_start = renderer.render_count
+    os.makedirs(output_dir, exist_ok=True)
+
     # Load the MusicXML file
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
+        with trace.phase('parse'):
+            score_hash = file_hash(file_path)
+            tree = parse(file_path)
+            root = tree.getroot()
     except ET.ParseError as e:
-        print(f"Error parsing MusicXML file: {e}")
-        return
+        logger.error("Error parsing MusicXML file: %s", e)
+        result.error = f"Error parsing MusicXML file: {e}"
+        return result
 
     # Remove all new-system and new-page breaks
-    remove_page_and_system_breaks(root)
+    with trace.phase('parse'):
+        remove_page_and_system_breaks(root)
 
     parts = root.findall('.//part')
+    with trace.phase('index'):
+        records = {part.get('id'): index_measures(part.findall('measure')) for part in parts}
     page_number = 1
-
-    for part in parts:
-        part_id = part.get('id')
-        print(f"Part ID: {part_id}")
-
-        current_measures = list(part.findall('measure'))
-        measure_index = 0
-        total_measures = len(current_measures)
-
-        while measure_index < total_measures:
-            # Create the first page (mostly blank)
-            empty_measure = create_empty_measure()
-
-            # Implement binary search to find the maximum number of measures that can fit on a page
-            low = 0
-            high = total_measures - measure_index
-            best_fit = 0
-            first_measure = current_measures[measure_index:measure_index+1]
-            add_new_page_break(first_measure[0])
-            find_and_add_last_attributes(first_measure[0], current_measures[:measure_index])
-            while low <= high:
-                mid = (low + high) // 2
-                measures_for_second_page = first_measure + current_measures[measure_index+1:measure_index + mid]
-
-                # Create a temporary MusicXML structure to test the layout
-                temp_root = ET.Element(root.tag, root.attrib)
-                copy_metadata_sections(root, temp_root)
-
-                temp_part = ET.SubElement(temp_root, 'part', {'id': part_id})
-                temp_part.append(empty_measure)
-                temp_part.extend(measures_for_second_page)
-
-                # Create the third page with a new page break at the start
-                last_measure = create_empty_measure()
-                add_new_page_break(last_measure)
-                temp_part.append(last_measure)
-
-                temp_file_path = os.path.join(output_dir, 'temp.xml')
-                temp_file_path_1 = os.path.join(output_dir, 'temp-1.xml')
-                if os.path.exists(temp_file_path):
-                    shutil.copy(temp_file_path, temp_file_path_1)
-                write_pretty_xml(temp_root, temp_file_path)
-
-                temp_pdf_path = temp_file_path.replace('.xml', '.pdf')
-                temp_pdf_path_1 = temp_file_path_1.replace('.xml', '.pdf')
-                if os.path.exists(temp_pdf_path):
-                    shutil.copy(temp_pdf_path, temp_pdf_path_1)
-                os.system(f"musescore-portable-nightly {temp_file_path} -o {temp_pdf_path}")
-
-                # Check the PDF page count
-                if check_pdf_page_count(temp_pdf_path) <= 3:
-                    best_fit = mid
-                    low = mid + 1
-                else:
-                    high = mid - 1
-
-                # Clean up temporary files
-                os.remove(temp_file_path)
-                os.remove(temp_pdf_path)
-
-            # Add the best fitting measures to the page
-            measure_index += best_fit
-
-            # Save the section to an output file
-            if best_fit > 0:
-                save_my_musicxml(part_id, page_number, current_measures, measure_index, best_fit, output_dir, root, empty_measure, total_measures)
-
+    previous_fit = None
+    assembler = DocumentAssembler(root)
+    estimator = LayoutEstimator(root) if search in ('estimate', 'plan') else None
+    concurrent = part_workers > 1 and len(parts) > 1
+    layouts = {}
+    if search == 'layout':
+        # Parts that a resumed split keeps in full need no layout
+        layout_parts = unfinished_parts(parts, records, score_hash, output_dir, concurrent) if resume else parts
+        if layout_parts:
+            with trace.phase('layout'):
+                layouts = render_layouts(assembler, layout_parts, records, output_dir, renderer)
+
+    score = SharedScore(root, score_hash, assembler, records, layouts)
+    options = dict(search=search, workers=workers, pretty=pretty, trace=trace, resume=resume, audio=audio,
+                   incremental=incremental)
+    if concurrent:
+        part_splits = split_parts_concurrently(parts, score, output_dir, renderer, part_workers, estimator is not None,
+                                               **options)
+    else:
+        for part in parts:
+            sections, page_number, previous_fit = split_part(part, score, output_dir, renderer, page_number,
+                                                             previous_fit, estimator, **options)
+            result.sections.extend(sections)
+        part_splits = None
+
+    if audio is not None:
+        with trace.phase('audio'):
+            audio.flush()
+    if part_splits is not None:
+        with trace.phase('save'):
+            result.sections, page_number = link_part_outputs(part_splits, output_dir, page_number, audio)
+
+    if result.sections:
+        average = sum(section['renders'] for section in result.sections) / len(result.sections)
+        logger.info("Average renders per section: %.2f", average)
+    result.page_number = page_number
+    result.render_count = renderer.render_count - renders_at_start
+    result.seconds = time.perf_counter() - start_time
+    result.trace = trace.to_dict()
+    return result
+
+
+# What all parts of one split share: the parsed score and its hash, the assembler with the serialized
+# fragments of its documents, the MeasureRecords of every part, keyed by part ID, and the break-free
+# layouts of its parts, if any
+SharedScore = namedtuple('SharedScore', ['root', 'score_hash', 'assembler', 'records', 'layouts'])
+
+
+def split_part(part, score, output_dir, renderer, page_number=1, previous_fit=None, estimator=None, search='binary',
+               workers=1, pretty=False, trace=NULL_TRACE, resume=True, audio=None, incremental=False):
+    """
+    Splits one part of a SharedScore into sections numbered from page_number and records them in
+    the part's checkpoint in output_dir. Returns the part's section dicts, the next page number
+    and the last fit found.
+
+    The fit of each section is searched with the search strategy:
+    'binary' - bisect the remaining measures (search.binary_search_fit);
+    'kary' - render `workers` candidate counts per round (search.kary_search_fit);
+    'gallop' - gallop out from the previous section's fit (search.galloping_search_fit);
+    'estimate' - confirm the ends of the fit interval the estimator predicts, and calibrate it on
+    every fit found (search.interval_search_fit);
+    'layout' - take the fits from the pages of the part's break-free layout in score.layouts
+    (see layout_sections) and only probe the uncertain boundaries;
+    'plan' - as 'estimate' until the estimator is calibrated, then plan the rest of the part with
+    planner.plan_sections and verify the next planned sections in one batch (see plan_and_verify).
+    A section taken from a layout or plan that overflows its page is searched with 'gallop'
+    instead, and after a failed plan the rest is planned again once the estimator has changed.
+
+    With resume=True the checkpointed sections whose outputs are intact are kept and only the
+    measures after them are searched. With incremental=True, after an edit of the score, the
+    sections of the previous plan that the edit does not affect are reused too, as matched by
+    checkpoint.PreviousPlan on the fingerprints of the measures: those before the first changed
+    measure and, once a section boundary after the edit lines up with the previous plan again,
+    all after it. The previous plan stays in the checkpoint until the part is split, so an
+    interrupted incremental split still reuses it when resumed.
+    """
+    root, score_hash, assembler, part_records, layouts = score
+    sections = []
+    part_id = part.get('id')
+    logger.info("Part ID: %s", part_id)
+
+    records = part_records[part_id]
+    current_measures = [record.element for record in records]
+    measure_index = 0
+    total_measures = len(current_measures)
+    with trace.phase('carry_state'):
+        carry_states = build_carry_state_index(records)
+
+    # Keep the sections a previous run completed
+    checkpoint = Checkpoint(output_dir, part_id, score_hash)
+    if not resume:
+        checkpoint.sections = []
+    with trace.phase('fingerprint'):
+        checkpoint.header = fingerprint(assembler.header)
+        checkpoint.fingerprints = [fingerprint(assembler.measure_bytes(measure)) for measure in current_measures]
+    kept = checkpoint.resume(page_number)
+    # After an edit, the plan of the previous version, whose sections the edit does not affect are reused
+    previous = None
+    if incremental and resume and checkpoint.previous is not None:
+        stashed = checkpoint.stashed
+        if not stashed:
+            # Record the previous plan before its outputs are moved aside, so that an interrupted split keeps it
+            checkpoint.stashed = True
+            checkpoint.save()
+        previous = PreviousPlan(checkpoint.previous, output_dir, part_id, checkpoint.fingerprints,
+                                checkpoint.header, stashed)
+
+    def keep_sections(kept_sections, restore=False):
+        nonlocal measure_index, previous_fit, page_number
+        for section in kept_sections:
+            if restore:
+                checkpoint.add(page_number, measure_index, section['best_fit'],
+                               previous.restore(section, page_number), section.get('state'))
+            sections.append({'part_id': part_id, 'page_number': page_number,
+                             'measure_index': measure_index, 'best_fit': section['best_fit'],
+                             'renders': 0})
+            if estimator is not None:
+                estimator.calibrate(part_id, records, measure_index, section['best_fit'])
+            measure_index += section['best_fit']
+            previous_fit = section['best_fit'] or previous_fit
+            if audio is not None and section['best_fit'] > 0:
+                audio.submit(os.path.join(output_dir, f"section_{page_number}_part_{part_id}.xml"),
+                             overwrite=False)
             page_number += 1
+        trace.count('reused_sections', len(kept_sections))
+
+    keep_sections(kept)
+    if previous is not None and not kept:
+        keep_sections(previous.prefix(), restore=True)
+    if measure_index:
+        logger.info("Resuming part %s at measure %s", part_id, measure_index)
+
+    plans = {}
+    planned_page_counts = {}
+    # The estimator scale of the last plan that did not verify; the same scale would plan the same again
+    failed_plan_scale = None
+    while measure_index < total_measures:
+        renders_before = renderer.render_count
+        state = fingerprint(carry_state_bytes(carry_states[measure_index]))
+
+        # Past an edit, reuse the rest of the previous plan once a section boundary lines up with it again
+        if previous is not None:
+            reused = previous.aligned(measure_index, state)
+            if reused:
+                logger.info("Section %s of part %s lines up with the previous plan, reusing %s sections",
+                            page_number, part_id, len(reused))
+                keep_sections(reused, restore=True)
+                break
+
+        # Plan the rest of the part once the estimator is calibrated
+        if (search == 'plan' and measure_index not in plans and estimator.scale is not None
+                and estimator.scale != failed_plan_scale):
+            with trace.phase('plan'):
+                verified, failed = plan_and_verify(assembler, estimator, part_id, records, carry_states,
+                                                   measure_index, page_number, output_dir, renderer, trace)
+            if failed:
+                failed_plan_scale = estimator.scale
+            for section, page_count in verified:
+                plans[section.measure_index] = section
+                planned_page_counts[section.measure_index] = page_count
+
+        # Search for the maximum number of measures that can fit on a page
+        low = 0
+        high = total_measures - measure_index
+        with trace.phase('carry_state'):
+            section = start_section(current_measures, measure_index, carry_states[measure_index])
+
+        def fits_many(mids):
+            # Every probe shows the section's first measure, even one of zero measures
+            probes = [section.replace(stop=measure_index + max(mid, 1)) for mid in mids]
+            return probe_fits(assembler, part_id, probes, output_dir, renderer, trace)
+
+        planned = layouts.get(part_id, {}).get(measure_index) or plans.get(measure_index)
+        planned_page_count = planned_page_counts.pop(measure_index, None)
+        with trace.phase('search'):
+            if planned is not None and not planned.verify:
+                best_fit = min(planned.fit, high)
+            elif planned is not None:
+                best_fit = interval_search_fit(lambda mid: fits_many([mid])[0], low, high, planned.fit, planned.fit)
+            elif search == 'kary':
+                best_fit = kary_search_fit(fits_many, low, high, workers)
+            elif search in ('gallop', 'layout') and previous_fit is not None:
+                best_fit = galloping_search_fit(lambda mid: fits_many([mid])[0], previous_fit, low, high)
+            elif search in ('estimate', 'plan'):
+                guess_low, guess_high = estimator.fit_interval(part_id, records, measure_index)
+                best_fit = interval_search_fit(lambda mid: fits_many([mid])[0], low, high, guess_low, guess_high)
+                estimator.calibrate(part_id, records, measure_index, best_fit)
+            else:
+                best_fit = binary_search_fit(lambda mid: fits_many([mid])[0], low, high)
+
+        # Add the best fitting measures to the page
+        measure_index += best_fit
+
+        # Save the section to an output file
+        if best_fit > 0:
+            with trace.phase('save'):
+                try:
+                    save_my_musicxml(part_id, page_number, section.replace(stop=measure_index), output_dir, root, renderer,
+                                     assembler, pretty, trace, audio, planned_page_count)
+                except ValueError:
+                    if planned is None or planned.verify:
+                        raise
+                    # The section overflows its page, so the layout does not hold here: search it instead
+                    logger.info("Planned fit of %s measures overflows section %s, searching", best_fit, page_number)
+                    measure_index -= best_fit
+                    with trace.phase('search'):
+                        best_fit = galloping_search_fit(lambda mid: fits_many([mid])[0], best_fit - 1, low, high)
+                    measure_index += best_fit
+                    save_my_musicxml(part_id, page_number, section.replace(stop=measure_index), output_dir, root,
+                                     renderer, assembler, pretty, trace, audio)
+            previous_fit = best_fit
+
+        checkpoint.add(page_number, measure_index - best_fit, best_fit,
+                       [os.path.join(output_dir, f"section_{page_number}_part_{part_id}.{extension}")
+                        for extension in ('xml', 'pdf')], state)
+
+        renders = renderer.render_count - renders_before
+        sections.append({'part_id': part_id, 'page_number': page_number,
+                         'measure_index': measure_index - best_fit, 'best_fit': best_fit,
+                         'renders': renders})
+        trace.count('sections')
+        logger.info("Section %s of part %s: %s measures, %s renders", page_number, part_id, best_fit, renders)
+
+        page_number += 1
+
+    checkpoint.finish()
+    return sections, page_number, previous_fit
+
+
+def split_parts_concurrently(parts, score, output_dir, renderer, part_workers, estimate=False, **options):
+    """
+    Splits the parts of a SharedScore at the same time, on part_workers threads. Each part is
+    split in its own scratch directory, output_dir/part_<id>, which holds its probe files and its
+    checkpoint, with sections numbered from 1, its own renderer from renderer.share(), which
+    draws on renderer's process slots, and, if estimate, its own LayoutEstimator, so that its
+    sections do not depend on the other parts.
+    Returns the (part ID, scratch directory, sections) of every part, in score order.
+    """
+    def run(part):
+        scratch_dir = os.path.join(output_dir, f"part_{part.get('id')}")
+        os.makedirs(scratch_dir, exist_ok=True)
+        estimator = LayoutEstimator(score.root) if estimate else None
+        with renderer.share() as part_renderer:
+            sections, _, _ = split_part(part, score, scratch_dir, part_renderer, estimator=estimator, **options)
+        return part.get('id'), scratch_dir, sections
 
-    return page_number
-
+    with ThreadPoolExecutor(max_workers=part_workers) as pool:
+        return list(pool.map(run, parts))
 
-def save_my_musicxml(part_id, page_number, current_measures, measure_index, best_fit, output_dir, root, empty_measure, total_measures):
 
-    measures_for_second_page = current_measures[measure_index - best_fit:measure_index]
+def link_part_outputs(part_splits, output_dir, page_number=1, audio=None):
+    """
+    Links the section outputs of the parts split by split_parts_concurrently into output_dir,
+    numbering the sections across parts in score order from page_number, as a serial split
+    does, and removes the part's section files there that the split no longer produces, e.g.
+    after a part shrank. The outputs stay in the scratch directories, where the parts'
+    checkpoints find them. Returns the merged section dicts and the next page number.
+    """
+    extensions = ['.xml', '.pdf'] + [f'.{audio_format}' for audio_format in (audio.formats if audio else ())]
+    sections = []
+    for part_id, scratch_dir, part_sections in part_splits:
+        linked = set()
+        for section in part_sections:
+            for extension in extensions:
+                scratch_path = os.path.join(scratch_dir, f"section_{section['page_number']}_part_{part_id}{extension}")
+                if not os.path.exists(scratch_path):
+                    continue
+                file_path = os.path.join(output_dir, f"section_{page_number}_part_{part_id}{extension}")
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                try:
+                    os.link(scratch_path, file_path)
+                except OSError:
+                    shutil.copyfile(scratch_path, file_path)
+                linked.add(file_path)
+            sections.append(dict(section, page_number=page_number))
+            page_number += 1
+        for file_path in glob.glob(os.path.join(glob.escape(output_dir), f"section_*_part_{glob.escape(part_id)}.*")):
+            if file_path not in linked:
+                os.remove(file_path)
+    return sections, page_number
 
-    temp_root = ET.Element(root.tag, root.attrib)
 
-    copy_metadata_sections(root, temp_root)
+def layout_sections(positions, edge_tolerance=0.1):
+    """
+    Derives one section per page from the measure positions of a break-free render.
 
-    temp_part = ET.SubElement(temp_root, 'part', {'id': part_id})
-    temp_part.append(empty_measure)
-    temp_part.extend(measures_for_second_page)
+    A boundary is marked for verification on the first page, whose title space the section
+    renders do not have, and where the free space below the last system is within
+    edge_tolerance of the space the next system needs, so that the small differences of the
+    section render (the carried-over attributes of its first measure) could move it.
+    """
+    pages = {}
+    for measure_index, position in enumerate(positions):
+        pages.setdefault(position.page, []).append((measure_index, position))
+    pages = [pages[page] for page in sorted(pages)]
+
+    def systems(page):
+        return sorted({(position.y, position.height) for _, position in page})
+
+    bottoms = [max(y + height for y, height in systems(page)) for page in pages]
+    gaps = [next_y - (y + height) for page in pages
+            for (y, height), (next_y, _) in zip(systems(page), systems(page)[1:])]
+    gap = min(gaps, default=0.0)
+
+    sections = []
+    for page_number, page in enumerate(pages):
+        verify = page_number == 0
+        if page_number + 1 < len(pages):
+            needed = gap + systems(pages[page_number + 1])[0][1]
+            verify = verify or abs(max(bottoms) - bottoms[page_number] - needed) <= edge_tolerance * needed
+        sections.append(LayoutSection(page[0][0], len(page), verify))
+    return sections
+
+
+def unfinished_parts(parts, records, score_hash, output_dir, concurrent=False):
+    """
+    Returns the parts that a resumed split still has measures to search in, that is all parts but
+    those whose checkpoints keep every measure, given the MeasureRecords of every part, keyed by
+    part ID. Parts split concurrently are checked in their scratch directories; in a serial split,
+    every part after an unfinished one is unfinished too, as its page numbers are not known yet.
+    """
+    unfinished = []
+    page_number = 1
+    for part in parts:
+        part_id = part.get('id')
+        if concurrent:
+            kept = Checkpoint(os.path.join(output_dir, f"part_{part_id}"), part_id, score_hash).keepable(1)
+        elif not unfinished:
+            kept = Checkpoint(output_dir, part_id, score_hash).keepable(page_number)
+            page_number += len(kept)
+        else:
+            kept = []
+        if sum(section['best_fit'] for section in kept) != len(records[part_id]):
+            unfinished.append(part)
+    return unfinished
+
+
+def render_layouts(assembler, parts, records, output_dir, renderer):
+    """
+    Renders every part once, without breaks, to MuseScore's measure positions (.mpos) in a
+    single batch, given the MeasureRecords of every part, keyed by part ID. Returns the
+    LayoutSections of every part, keyed by part ID and first measure.
+    """
+    jobs = []
+    for part in parts:
+        layout_file_path = os.path.join(output_dir, f"layout_{part.get('id')}.xml")
+        assembler.write(layout_file_path, part.get('id'), [record.element for record in records[part.get('id')]])
+        jobs.append((layout_file_path, layout_file_path.replace('.xml', '.mpos')))
+
+    layouts = {}
+    for part, positions in zip(parts, renderer.measure_positions_batch(jobs)):
+        sections = layout_sections(positions)
+        layouts[part.get('id')] = {section.measure_index: section for section in sections}
+        logger.info("Layout of part %s: %s pages, %s to verify", part.get('id'), len(sections),
+                    sum(section.verify for section in sections))
+
+    # Clean up temporary files
+    for layout_file_path, mpos_path in jobs:
+        os.remove(layout_file_path)
+        os.remove(mpos_path)
+    return layouts
+
+
+def plan_and_verify(assembler, estimator, part_id, records, carry_states, measure_index, page_number,
+                    output_dir, renderer, trace=NULL_TRACE, max_sections=8):
+    """
+    Plans the sections of a part from measure_index on with planner.plan_sections, using the
+    estimator's calibrated measure widths, and renders the three-page document of each of the
+    first max_sections planned sections, as save_my_musicxml would, to its _tmp3 path in a
+    single batch. The cap bounds the renders a wrong plan wastes; the sections after it are
+    planned again once these are saved.
+
+    Returns the (LayoutSection, page count) pairs of the planned sections up to the first one
+    that does not fit its page, whose document and those of the sections after it are removed,
+    and whether there was such a section. The measures of the part are not modified: planned
+    sections are SectionViews.
+    """
+    current_measures = [record.element for record in records]
+    prefix, geometry = estimator.part_widths(part_id, records)
+    widths = [prefix[index + 1] - prefix[index] for index in range(measure_index, len(current_measures))]
+    fits = plan_sections(widths, geometry.capacity * estimator.scale)[:max_sections]
+
+    jobs = []
+    sections = []
+    start = measure_index
+    for section_number, fit in enumerate(fits):
+        is_last = start + fit == len(current_measures)
+        section = start_section(current_measures, start, carry_states[start])
+        section = section.replace(stop=start + fit, lead_out=None if is_last else section.lead_out)
+
+        file_path = os.path.join(output_dir, f"section_{page_number + section_number}_part_{part_id}_tmp3.xml")
+        with trace.phase('serialize'):
+            assembler.write(file_path, part_id, section)
+        assembler.invalidate(section.measure(start))
+        jobs.append((file_path, file_path.replace('.xml', '.pdf')))
+        sections.append((LayoutSection(start, fit, False), is_last))
+        start += fit
+    trace.count('planned_sections', len(jobs))
+
+    verified = []
+    for job_number, render_result in enumerate(renderer.render_batch(jobs)):
+        section, is_last = sections[job_number]
+        if not section_fits(render_result.page_count, is_last):
+            logger.info("Planned section of %s measures at measure %s does not fit, %s of %s planned sections kept",
+                        section.fit, section.measure_index, job_number, len(jobs))
+            # Clean up the documents of the sections that will be searched again
+            for file_path, pdf_path in jobs[job_number:]:
+                os.remove(file_path)
+                os.remove(pdf_path)
+            return verified, True
+        verified.append((section, render_result.page_count))
+    return verified, False
+
+
+def probe_fits(assembler, part_id, probes, output_dir, renderer, trace=NULL_TRACE):
+    """
+    Renders one probe document per list of measures and returns, per probe, whether it fits
+    on three pages. Every probe gets its own file name so probes rendered together never
+    overwrite each other. The probes must be ordered by growing length: the renderer may skip
+    those whose outcome follows from the others.
+    """
+    jobs = []
+    for probe_number, probe_measures in enumerate(probes):
+        name = 'temp.xml' if len(probes) == 1 else f'temp_{part_id}_{probe_number}.xml'
+        temp_file_path = os.path.join(output_dir, name)
+        with trace.phase('serialize'):
+            assembler.write(temp_file_path, part_id, probe_measures)
+        jobs.append((temp_file_path, temp_file_path.replace('.xml', '.pdf')))
+
+    trace.count('probes', len(jobs))
+    fits = renderer.fits_batch(jobs, lambda page_count: page_count <= 3)
+
+    # Clean up temporary files; cancelled probes have no PDF
+    for temp_file_path, temp_pdf_path in jobs:
+        os.remove(temp_file_path)
+        if os.path.exists(temp_pdf_path):
+            os.remove(temp_pdf_path)
+    return fits
+
+
+def save_my_musicxml(part_id, page_number, section, output_dir, root, renderer=None, assembler=None, pretty=False,
+                     trace=NULL_TRACE, audio=None, page_count=None):
+    """
+    Renders a section, given as a SectionView from start_section, padded with an empty page
+    before and after it and, if it comes out as three pages, saves the section's MusicXML and
+    middle PDF page. Raises ValueError if the section overflows (see section_fits). Pass the
+    page count of an existing _tmp3 render of the same document, e.g. from plan_and_verify, to
+    skip rendering it again.
+    """
+    if renderer is None:
+        renderer = AsyncRenderer('musescore-portable-nightly')
+    if assembler is None:
+        assembler = DocumentAssembler(root)
 
     # check if is the last page
-    if measure_index == total_measures:
-        add_final_barline(measures_for_second_page[-1])
-        is_last = True
-    else:
-        is_last = False
-        last_measure = create_empty_measure()
-        add_new_page_break(last_measure)
-        temp_part.append(last_measure)
+    is_last = section.stop == len(section.measures)
+    if is_last:
+        section = section.overlaid(section.stop - 1, add_final_barline).replace(lead_out=None)
+    measures_for_second_page = section.replace(lead_in=None, lead_out=None)
 
     final_file_path = os.path.join(output_dir, f"section_{page_number}_part_{part_id}_tmp3.xml")
-    write_pretty_xml(temp_root, final_file_path)
-
     final_pdf_path = final_file_path.replace('.xml', '.pdf')
-    os.system(f"musescore-portable-nightly {final_file_path} -o {final_pdf_path}")
+    if page_count is None:
+        with trace.phase('serialize'):
+            assembler.write(final_file_path, part_id, section)
+        page_count = renderer.render(final_file_path, final_pdf_path).page_count
 
     # Check the PDF page count
-    if check_pdf_page_count(final_pdf_path) == 3 or (check_pdf_page_count(final_pdf_path) == 2 and (is_last)):
-        print(f"PDF page count is 3 for {final_pdf_path}")
+    if section_fits(page_count, is_last):
+        logger.info("PDF page count is %s for %s", page_count, final_pdf_path)
         # remove first measure and last measure
-        temp_part.remove(empty_measure)
-        if not is_last:
-            temp_part.remove(last_measure)
-        write_pretty_xml(temp_root, final_file_path.replace('_tmp3.xml', '.xml'))
-        # TODO save audio because it is slow...and i can do it in parallel with musecore -J
+        with trace.phase('serialize'):
+            if pretty:
+                write_pretty_xml(assembler.document(part_id, measures_for_second_page), final_file_path.replace('_tmp3.xml', '.xml'))
+            else:
+                assembler.write(final_file_path.replace('_tmp3.xml', '.xml'), part_id, measures_for_second_page)
+        # Export audio in the background while the next sections are searched
+        if audio is not None:
+            audio.submit(final_file_path.replace('_tmp3.xml', '.xml'))
         # save final PDF
-        pdf_reader = PdfReader(final_pdf_path)
-        final_pdf_path = final_pdf_path.replace('_tmp3.pdf', '.pdf')
-        # If the exception handling is desired instead of just raising an exception:
-        # Remove the first and last pages to create a new PDF
-        pdf_writer = PdfWriter()
-        index_content = 1
-        pdf_writer.add_page(pdf_reader.pages[index_content])
-        # Write the new PDF file with the same name, replacing the original
-        with open(final_pdf_path, 'wb') as new_pdf_file:
-            pdf_writer.write(new_pdf_file)
-    elif not is_last:
-        raise ValueError(f"PDF page count is not 3 for {final_pdf_path}")
+        with trace.phase('pdf'):
+            pdf_reader = PdfReader(final_pdf_path)
+            final_pdf_path = final_pdf_path.replace('_tmp3.pdf', '.pdf')
+            # If the exception handling is desired instead of just raising an exception:
+            # Remove the first and last pages to create a new PDF
+            pdf_writer = PdfWriter()
+            index_content = 1
+            pdf_writer.add_page(pdf_reader.pages[index_content])
+            # Write the new PDF file with the same name, replacing the original
+            with open(final_pdf_path, 'wb') as new_pdf_file:
+                pdf_writer.write(new_pdf_file)
+    else:
+        raise ValueError(f"PDF page count is {page_count}, not {2 if is_last else 3}, for {final_pdf_path}")
+
+
+def section_fits(page_count, is_last):
+    """
+    Checks the page count of a section's padded render: three pages, or two for the last
+    section, which has no page after it. Anything else means the section overflowed its page.
+    """
+    return page_count == (2 if is_last else 3)
 
 
 def create_empty_measure():
@@ -211,12 +644,27 @@ def add_new_page_break(measure):
     print_element = ET.Element('print', {'new-page': 'yes'})
     measure.append(print_element)
 
+# The padding measures around every section. They are never modified, so all probes and sections share them
+EMPTY_MEASURE = create_empty_measure()
+PAGE_BREAK_MEASURE = create_empty_measure()
+add_new_page_break(PAGE_BREAK_MEASURE)
+
+
+def start_section(measures, measure_index, state):
+    """
+    Returns the SectionView of the section of a part starting at measure_index, up to the end of
+    the part, between an empty page and a new page. Its first measure is an overlay with a new
+    page break and the given carry state; the measures themselves are not modified.
+    """
+    section = SectionView(measures, measure_index, len(measures), EMPTY_MEASURE, PAGE_BREAK_MEASURE)
+    return section.overlaid(measure_index, add_new_page_break, lambda measure: add_carry_state(measure, state))
+
 def check_pdf_page_count(pdf_file_path):
     """Check the number of pages in a PDF."""
-    pdf_reader = PdfReader(pdf_file_path)
-    return len(pdf_reader.pages)
+    return pdf_page_count(pdf_file_path)
 
 if __name__ == '__main__':
     # Specify the path to your MusicXML file
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     file_path = 'example/4240.musicxml'
-    split_musicxml_by_page(file_path)
+    split_musicxml_by_page(file_path, renderer=AsyncRenderer('musescore-portable-nightly', cache=RenderCache()))
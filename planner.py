@@ -0,0 +1,38 @@
+def plan_sections(widths, capacity, max_fill=0.97):
+    """
+    Partitions measures, given their estimated widths, into pages in one dynamic programming
+    pass. Every page holds at most max_fill * capacity of width; the partition has the fewest
+    pages and, among those, the least raggedness: the sum over all pages, the last one
+    included, of the squared unused fraction of the page. Pages therefore come out balanced
+    instead of full pages followed by an underfull last one.
+
+    Returns the number of measures on each page. A measure wider than a page gets a page of
+    its own.
+    """
+    limit = capacity * max_fill
+    prefix = [0.0]
+    for width in widths:
+        prefix.append(prefix[-1] + width)
+
+    # best[i] is the (pages, raggedness) of the best partition of the first i measures,
+    # and first[i] is where its last page starts
+    best = [(0, 0.0)] + [None] * len(widths)
+    first = [0] * (len(widths) + 1)
+    window_start = 0
+    for end in range(1, len(widths) + 1):
+        while window_start < end - 1 and prefix[end] - prefix[window_start] > limit:
+            window_start += 1
+        for start in range(window_start, end):
+            unused = max(0.0, limit - (prefix[end] - prefix[start])) / limit if limit > 0 else 0.0
+            pages, raggedness = best[start]
+            cost = (pages + 1, raggedness + unused * unused)
+            if best[end] is None or cost < best[end]:
+                best[end] = cost
+                first[end] = start
+
+    fits = []
+    end = len(widths)
+    while end > 0:
+        fits.append(end - first[end])
+        end = first[end]
+    return fits[::-1]
@@ -0,0 +1,577 @@
+import asyncio
+import copy
+import json
+import logging
+import mmap
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from PyPDF2 import PdfReader
+
+from instrument import NULL_TRACE
+
+
+logger = logging.getLogger(__name__)
+
+RenderResult = namedtuple('RenderResult', ['xml_path', 'pdf_path', 'page_count'])
+# Where MuseScore laid a measure out: its 0-based page and its bounding box on that page
+MeasurePosition = namedtuple('MeasurePosition', ['page', 'x', 'y', 'width', 'height'])
+
+
+class RenderError(RuntimeError):
+    """Raised when the renderer did not produce the requested output."""
+
+
+class RenderTimeout(RenderError):
+    """Raised when the renderer did not finish within its timeout."""
+
+
+_STARTXREF = re.compile(rb'startxref\s+(\d+)')
+_XREF_SUBSECTION = re.compile(rb'(\d+)\s+(\d+)\s*[\r\n]+')
+_ROOT = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+_PAGES = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+_PREV = re.compile(rb'/Prev\s+(\d+)')
+_COUNT = re.compile(rb'/Count\s+(\d+)(?!\d)(?!\s+\d+\s+R)')
+
+
+def _xref_offset(data, xref_offset, object_number):
+    """
+    Looks an object up in a classic xref table and its /Prev chain.
+    Returns its byte offset, or None if it is not listed (e.g. the file uses xref streams).
+    """
+    while xref_offset is not None and data[xref_offset:xref_offset + 4] == b'xref':
+        position = xref_offset + 4
+        while True:
+            while data[position:position + 1] in (b' ', b'\r', b'\n'):
+                position += 1
+            subsection = _XREF_SUBSECTION.match(data, position)
+            if subsection is None:
+                break
+            first, count = int(subsection.group(1)), int(subsection.group(2))
+            position = subsection.end()
+            if first <= object_number < first + count:
+                entry = data[position + 20 * (object_number - first):position + 20 * (object_number - first) + 18]
+                offset, _, kind = entry.split()
+                return int(offset) if kind == b'n' else None
+            position += 20 * count
+        trailer = data[position:data.find(b'>>', position) + 2]
+        prev = _PREV.search(trailer)
+        xref_offset = int(prev.group(1)) if prev else None
+    return None
+
+
+def _object_body(data, xref_offset, object_number, generation):
+    """Returns the bytes of an indirect object, found through the xref table or by searching for it."""
+    offset = _xref_offset(data, xref_offset, object_number)
+    if offset is None:
+        # The last definition wins in incrementally updated files
+        header = b'%d %d obj' % (object_number, generation)
+        offset = data.rfind(header)
+        # Skip matches inside larger object numbers, e.g. "12 0 obj" in "112 0 obj"
+        while offset > 0 and data[offset - 1:offset].isdigit():
+            offset = data.rfind(header, 0, offset)
+        if offset < 0:
+            raise ValueError(f"Object {object_number} not found")
+    return data[offset:data.find(b'endobj', offset)]
+
+
+def fast_pdf_page_count(pdf_file_path):
+    """
+    Reads the page count from the /Count of the page tree root, following only the trailer,
+    the xref table and two objects instead of parsing the whole PDF.
+    Raises ValueError if the file does not have that layout, e.g. when the page tree lives in a
+    compressed object stream.
+    """
+    with open(pdf_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        tail = data[max(0, len(data) - 2048):]
+        startxref = list(_STARTXREF.finditer(tail))
+        xref_offset = int(startxref[-1].group(1)) if startxref else None
+        root = list(_ROOT.finditer(tail)) or list(_ROOT.finditer(data))
+        if not root:
+            raise ValueError("Trailer has no /Root")
+        catalog = _object_body(data, xref_offset, int(root[-1].group(1)), int(root[-1].group(2)))
+        pages = _PAGES.search(catalog)
+        if pages is None:
+            raise ValueError("Catalog has no /Pages")
+        count = _COUNT.search(_object_body(data, xref_offset, int(pages.group(1)), int(pages.group(2))))
+        if count is None:
+            raise ValueError("Page tree root has no direct /Count")
+        return int(count.group(1))
+
+
+@lru_cache(maxsize=1024)
+def _memoized_page_count(pdf_file_path, inode, mtime_ns, ctime_ns, size):
+    try:
+        return fast_pdf_page_count(pdf_file_path)
+    except (ValueError, OSError, IndexError):
+        return len(PdfReader(pdf_file_path).pages)
+
+
+def pdf_page_count(pdf_file_path):
+    """
+    Check the number of pages in a PDF.
+    Uses fast_pdf_page_count, falling back to PyPDF2, and is memoized per rendered file.
+    """
+    stat = os.stat(pdf_file_path)
+    return _memoized_page_count(os.path.abspath(pdf_file_path), stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns,
+                                stat.st_size)
+
+
+def read_measure_positions(mpos_path):
+    """Reads a MuseScore measure position file (.mpos) and returns a MeasurePosition per measure, in order."""
+    elements = sorted(ET.parse(mpos_path).getroot().iter('element'), key=lambda element: int(element.get('id')))
+    return [MeasurePosition(int(element.get('page')), float(element.get('x')), float(element.get('y')),
+                            float(element.get('sx')), float(element.get('sy')))
+            for element in elements]
+
+
+class ProcessSlots:
+    """
+    Limits the number of renderer processes running at once, for threads and for the event loops
+    of any number of threads. Threads take a slot with `with slots:` and coroutines with
+    `async with slots:`. A released slot goes straight to the longest waiting thread or task; a
+    task that is cancelled while waiting takes none.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._running = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _take(self, grant):
+        """Takes a free slot and returns True, or queues grant, to be called when one is released."""
+        with self._lock:
+            if self._running < self.limit:
+                self._running += 1
+                return True
+            self._waiters.append(grant)
+            return False
+
+    def release(self):
+        """Hands the slot to the next waiter that can still take it, or frees it."""
+        with self._lock:
+            while self._waiters:
+                if self._waiters.popleft()():
+                    return
+            self._running -= 1
+
+    def __enter__(self):
+        granted = threading.Event()
+
+        def grant():
+            granted.set()
+            return True
+
+        if not self._take(grant):
+            granted.wait()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def hand_over():
+            # The slot was granted, but the task may have been cancelled since
+            if granted.cancelled():
+                self.release()
+            else:
+                granted.set_result(None)
+
+        def grant():
+            try:
+                loop.call_soon_threadsafe(hand_over)
+            except RuntimeError:
+                # The waiting task's event loop is closed
+                return False
+            return True
+
+        if self._take(grant):
+            return
+        try:
+            await granted
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove(grant)
+                except ValueError:
+                    # Already granted: hand_over passes the slot on
+                    pass
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class Renderer:
+    """
+    Converts MusicXML files to PDF with MuseScore.
+
+    Single conversions run the binary as `binary in.xml -o out.pdf`. Batches are written to a
+    MuseScore job file and converted with `binary -j jobs.json`, so MuseScore starts once per
+    worker instead of once per file. The binary is pluggable: pass a list such as
+    [sys.executable, 'stub_renderer.py'] to replace MuseScore with a local stub.
+
+    With a RenderCache, PDF renders whose MusicXML bytes were rendered before by the same
+    renderer version are served from the cache and do not count as renders.
+
+    With a Trace, cache lookups, renderer runs and page counting are timed as the phases
+    'render.cache', 'render.musescore' and 'render.page_count'.
+
+    At most `workers` renderer processes run at once, across this renderer and every renderer
+    shared from it.
+    """
+
+    def __init__(self, binary='musescore-portable-nightly', workers=1, cache=None, trace=None):
+        self.binary = binary
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.trace = trace if trace is not None else NULL_TRACE
+        self.render_count = 0
+        self._pool = None
+        self._version = None
+        self._lock = threading.Lock()
+        self._parent = None
+        # Process slots, shared with the renderers from share()
+        self._slots = ProcessSlots(self.workers)
+
+    def command(self, *args):
+        """Builds the command line for the renderer binary."""
+        binary = [self.binary] if isinstance(self.binary, str) else list(self.binary)
+        return binary + [str(arg) for arg in args]
+
+    def version(self):
+        """Returns the renderer version string, used to key the render cache."""
+        if self._version is None:
+            try:
+                output = subprocess.run(self.command('--version'), capture_output=True, text=True).stdout.strip()
+            except OSError:
+                output = ''
+            self._version = output or ' '.join(self.command())
+        return self._version
+
+    def pool(self):
+        """Returns the worker pool, starting it on first use."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def share(self):
+        """
+        Returns a renderer with this one's binary, cache, trace and settings that counts its own
+        renders, e.g. for one of several parts split at the same time. Its renders also count
+        for this renderer, and its processes draw on this renderer's `workers` process slots.
+        """
+        shared = copy.copy(self)
+        shared.render_count = 0
+        shared._pool = None
+        shared._lock = threading.Lock()
+        shared._parent = self
+        return shared
+
+    def count_renders(self, n):
+        """Adds n renderer conversions to the count of this renderer and of the one it was shared from."""
+        with self._lock:
+            self.render_count += n
+        if self._parent is not None:
+            self._parent.count_renders(n)
+
+    def close(self):
+        """Shuts down the worker pool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def convert(self, xml_path, out_path):
+        """Converts a single file, e.g. MusicXML to PDF."""
+        with self._slots:
+            subprocess.run(self.command(xml_path, '-o', out_path))
+        self.count_renders(1)
+        if not os.path.exists(out_path):
+            raise RenderError(f"Renderer did not produce {out_path}")
+
+    def convert_job_file(self, jobs):
+        """Converts a list of (in_path, out_path) pairs with a single renderer start."""
+        if len(jobs) == 1:
+            self.convert(*jobs[0])
+            return
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as job_file:
+            json.dump([{'in': os.path.abspath(xml_path), 'out': os.path.abspath(out_path)}
+                       for xml_path, out_path in jobs], job_file)
+        try:
+            with self._slots:
+                subprocess.run(self.command('-j', job_file.name))
+        finally:
+            os.remove(job_file.name)
+        self.count_renders(len(jobs))
+        for _, out_path in jobs:
+            if not os.path.exists(out_path):
+                raise RenderError(f"Renderer did not produce {out_path}")
+
+    def convert_batch(self, jobs):
+        """
+        Converts a queue of (in_path, out_path) jobs, spreading them over the worker pool.
+        Each worker converts its share through one job file.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        chunks = [jobs[i::self.workers] for i in range(min(self.workers, len(jobs)))]
+        if len(chunks) == 1:
+            self.convert_job_file(chunks[0])
+            return
+        for future in [self.pool().submit(self.convert_job_file, chunk) for chunk in chunks]:
+            future.result()
+
+    def render(self, xml_path, pdf_path):
+        """Renders a MusicXML file to PDF and returns its RenderResult."""
+        return self.render_batch([(xml_path, pdf_path)])[0]
+
+    def cache_lookup(self, xml_path, pdf_path):
+        """Returns the cache key of a job and its cached page count, or None if it is not cached."""
+        with open(xml_path, 'rb') as f:
+            key = self.cache.key(f.read(), self.version())
+        return key, self.cache.get(key, pdf_path)
+
+    def fits_batch(self, jobs, fits):
+        """
+        Renders a queue of (xml_path, pdf_path) probe jobs and returns fits(page_count) per job.
+        The jobs are ordered so that fits is True for a prefix of them, e.g. by growing measure
+        count, which lets subclasses skip the probes whose outcome follows from the others.
+        """
+        return [fits(result.page_count) for result in self.render_batch(jobs)]
+
+    def render_batch(self, jobs):
+        """
+        Renders a queue of (xml_path, pdf_path) jobs and returns a RenderResult per job,
+        in the same order as the jobs. Cached jobs are not rendered again.
+        """
+        jobs = list(jobs)
+        page_counts = [None] * len(jobs)
+        keys = [None] * len(jobs)
+        if self.cache is not None:
+            with self.trace.phase('render.cache'):
+                for job_number, (xml_path, pdf_path) in enumerate(jobs):
+                    keys[job_number], page_counts[job_number] = self.cache_lookup(xml_path, pdf_path)
+
+        missing = [job_number for job_number, page_count in enumerate(page_counts) if page_count is None]
+        self.trace.count('renders', len(missing))
+        self.trace.count('cache_hits', len(jobs) - len(missing))
+        with self.trace.phase('render.musescore'):
+            self.convert_batch([jobs[job_number] for job_number in missing])
+        with self.trace.phase('render.page_count'):
+            for job_number in missing:
+                page_counts[job_number] = pdf_page_count(jobs[job_number][1])
+        if self.cache is not None:
+            with self.trace.phase('render.cache'):
+                for job_number in missing:
+                    self.cache.put(keys[job_number], jobs[job_number][1], page_counts[job_number])
+
+        return [RenderResult(xml_path, pdf_path, page_count)
+                for (xml_path, pdf_path), page_count in zip(jobs, page_counts)]
+
+    def measure_positions_batch(self, jobs):
+        """
+        Lays out a queue of (xml_path, mpos_path) jobs with MuseScore's measure position export
+        and returns the list of MeasurePositions of every job, in the same order as the jobs.
+        """
+        jobs = list(jobs)
+        self.trace.count('renders', len(jobs))
+        with self.trace.phase('render.musescore'):
+            self.convert_batch(jobs)
+        return [read_measure_positions(mpos_path) for _, mpos_path in jobs]
+
+
+class AsyncRenderer(Renderer):
+    """
+    A Renderer that runs MuseScore as asyncio subprocesses.
+
+    At most `workers` processes run at once, those of shared renderers included. A process
+    that runs longer than `timeout` seconds per file it converts is killed, and a failed
+    conversion (timeout, non-zero exit status or missing output) is retried up to `retries`
+    times, waiting backoff, 2 * backoff, ... seconds in between. fits_batch renders the
+    probes of a search round concurrently, one process each, and cancels, killing their
+    processes, the probes whose outcome the finished ones imply.
+    """
+
+    def __init__(self, binary='musescore-portable-nightly', workers=1, cache=None, trace=None, timeout=300,
+                 retries=2, backoff=1.0):
+        super().__init__(binary, workers, cache, trace)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _run(self, args, out_paths):
+        """Runs the renderer once, with `timeout` seconds per output, and checks its exit status and outputs."""
+        timeout = self.timeout * len(out_paths)
+        for out_path in out_paths:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+        async with self._slots:
+            # A process must not be abandoned while it is being spawned, so a cancellation waits for the spawn
+            spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+                *self.command(*args), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE))
+            try:
+                process = await asyncio.shield(spawn)
+            except asyncio.CancelledError:
+                process = await spawn
+                await self._abandon(process, out_paths)
+                raise
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise RenderTimeout(f"Renderer timed out after {timeout}s on {args}")
+            except asyncio.CancelledError:
+                await self._abandon(process, out_paths)
+                raise
+        if process.returncode != 0:
+            raise RenderError(f"Renderer exited with status {process.returncode} on {args}: "
+                              f"{stderr.decode(errors='replace').strip()[-500:]}")
+        for out_path in out_paths:
+            if not os.path.exists(out_path):
+                raise RenderError(f"Renderer did not produce {out_path}")
+
+    @staticmethod
+    async def _kill(process):
+        """
+        Kills the process and waits for asyncio's child watcher to reap it. Process.kill() is not used,
+        as it reaps a process that already exited itself, and the watcher then logs it as an unknown child.
+        """
+        if process.returncode is None:
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+    @classmethod
+    async def _abandon(cls, process, out_paths):
+        """Kills and reaps the process of a cancelled run and removes its partial outputs."""
+        await cls._kill(process)
+        for out_path in out_paths:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+
+    async def convert_jobs(self, jobs, semaphore):
+        """Converts (in_path, out_path) jobs in one renderer process, retrying failures."""
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    if len(jobs) == 1:
+                        await self._run([jobs[0][0], '-o', jobs[0][1]], [jobs[0][1]])
+                    else:
+                        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as job_file:
+                            json.dump([{'in': os.path.abspath(xml_path), 'out': os.path.abspath(out_path)}
+                                       for xml_path, out_path in jobs], job_file)
+                        try:
+                            await self._run(['-j', job_file.name], [out_path for _, out_path in jobs])
+                        finally:
+                            os.remove(job_file.name)
+                break
+            except RenderError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("%s; retrying", e)
+                self.trace.count('retries')
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.count_renders(len(jobs))
+
+    async def convert_batch_async(self, jobs):
+        """Converts a queue of jobs, one job file per worker, with at most `workers` processes at once."""
+        semaphore = asyncio.Semaphore(self.workers)
+        chunks = [jobs[i::self.workers] for i in range(min(self.workers, len(jobs)))]
+        await asyncio.gather(*(self.convert_jobs(chunk, semaphore) for chunk in chunks))
+
+    def convert(self, xml_path, out_path):
+        """Converts a single file, e.g. MusicXML to PDF."""
+        self.convert_batch([(xml_path, out_path)])
+
+    def convert_job_file(self, jobs):
+        """Converts a list of (in_path, out_path) pairs with a single renderer start."""
+        asyncio.run(self.convert_jobs(list(jobs), asyncio.Semaphore(1)))
+
+    def convert_batch(self, jobs):
+        """Converts a queue of (in_path, out_path) jobs, spreading them over `workers` processes."""
+        jobs = list(jobs)
+        if jobs:
+            asyncio.run(self.convert_batch_async(jobs))
+
+    async def render_async(self, xml_path, pdf_path, semaphore):
+        """Renders one MusicXML file to PDF in its own process and returns its page count."""
+        key = None
+        if self.cache is not None:
+            key, page_count = self.cache_lookup(xml_path, pdf_path)
+            if page_count is not None:
+                self.trace.count('cache_hits')
+                return page_count
+        await self.convert_jobs([(xml_path, pdf_path)], semaphore)
+        # Counted once it ran, as cancelled probes are not renders
+        self.trace.count('renders')
+        with self.trace.phase('render.page_count'):
+            page_count = pdf_page_count(pdf_path)
+        if self.cache is not None:
+            self.cache.put(key, pdf_path, page_count)
+        return page_count
+
+    async def fits_batch_async(self, jobs, fits):
+        """
+        Renders probe jobs concurrently and returns fits(page_count) per job. As the jobs are
+        ordered so that fits holds for a prefix of them, a probe that fits implies that all
+        earlier ones fit and a probe that does not fit implies that no later one does; probes
+        decided that way are cancelled.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+        outcomes = [None] * len(jobs)
+        tasks = {asyncio.ensure_future(self.render_async(xml_path, pdf_path, semaphore)): job_number
+                 for job_number, (xml_path, pdf_path) in enumerate(jobs)}
+        cancelled = []
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job_number = tasks.pop(task)
+                    fit = fits(task.result())
+                    implied = range(job_number + 1) if fit else range(job_number, len(jobs))
+                    for implied_number in implied:
+                        if outcomes[implied_number] is None:
+                            outcomes[implied_number] = fit
+                for task, job_number in list(tasks.items()):
+                    if outcomes[job_number] is not None:
+                        task.cancel()
+                        del tasks[task]
+                        cancelled.append(task)
+                        self.trace.count('cancelled_probes')
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*cancelled, *tasks, return_exceptions=True)
+        return outcomes
+
+    def fits_batch(self, jobs, fits):
+        """
+        Renders a queue of (xml_path, pdf_path) probe jobs and returns fits(page_count) per job,
+        cancelling the probes whose outcome follows from the others. Cancelled probes leave no
+        PDF behind.
+        """
+        jobs = list(jobs)
+        if len(jobs) <= 1:
+            return super().fits_batch(jobs, fits)
+        with self.trace.phase('render.musescore'):
+            return asyncio.run(self.fits_batch_async(jobs, fits))
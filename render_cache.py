@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+class RenderCache:
+    """
+    Content-addressed on-disk cache of rendered PDFs.
+
+    Entries are keyed by the SHA-256 of the MusicXML bytes plus the renderer version, and store
+    the PDF together with its page count. When the PDFs exceed max_bytes the least recently used
+    entries are evicted. Entries are written atomically, so several processes can share a cache
+    directory.
+    """
+
+    def __init__(self, cache_dir='.render_cache', max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(xml_bytes, renderer_version):
+        """Returns the cache key of a MusicXML document for a renderer version."""
+        digest = hashlib.sha256(renderer_version.encode('UTF-8'))
+        digest.update(b'\0')
+        digest.update(xml_bytes)
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return base + '.pdf', base + '.json'
+
+    def get(self, key, pdf_path):
+        """
+        Copies the cached PDF to pdf_path and returns its page count, or None on a miss.
+        """
+        cached_pdf_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding='UTF-8') as f:
+                page_count = json.load(f)['page_count']
+            shutil.copyfile(cached_pdf_path, pdf_path)
+            # The modification time records the last use for LRU eviction
+            os.utime(cached_pdf_path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return page_count
+
+    def put(self, key, pdf_path, page_count):
+        """Stores a rendered PDF and its page count, then evicts old entries if needed."""
+        cached_pdf_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(cached_pdf_path), exist_ok=True)
+        tmp_suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(pdf_path, cached_pdf_path + tmp_suffix)
+        os.replace(cached_pdf_path + tmp_suffix, cached_pdf_path)
+        with open(meta_path + tmp_suffix, 'w', encoding='UTF-8') as f:
+            json.dump({'page_count': page_count}, f)
+        os.replace(meta_path + tmp_suffix, meta_path)
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(cached_pdf_path)
+        if self._size is None or self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is back under 90% of max_bytes,
+        so that eviction does not run again on every put.
+        """
+        entries = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.pdf'):
+                    try:
+                        stat = os.stat(os.path.join(dir_path, file_name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(dir_path, file_name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, cached_pdf_path in sorted(entries):
+            if total <= self.max_bytes * 0.9:
+                break
+            for path in (cached_pdf_path, cached_pdf_path[:-len('.pdf')] + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def stats(self):
+        """Returns the hit and miss counts and the hit rate."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,98 @@
+class MeasureRecord:
+    """
+    What the splitters need to know about one measure, extracted in a single pass over its
+    children so that later stages do not walk the tree again.
+
+    key, time, divisions, staves and the clefs (a tuple of (number attribute, clef) pairs) are
+    the elements of the measure's first <attributes>, or None; tempo and dynamic are the last
+    ones set by its directions. notes holds one (voice, chord, duration, accidental, lyric length)
+    tuple per note that is not a grace note, for estimator.measure_width; duration is None if
+    the note has none.
+    """
+    __slots__ = ('element', 'number', 'new_page', 'tempo', 'dynamic', 'key', 'time', 'clefs', 'divisions',
+                 'staves', 'notes')
+
+    def __init__(self, element):
+        self.element = element
+        try:
+            self.number = int(element.get('number', 0))
+        except ValueError:
+            self.number = None
+        self.new_page = False
+        self.tempo = None
+        self.dynamic = None
+        self.key = None
+        self.time = None
+        self.clefs = ()
+        self.divisions = None
+        self.staves = None
+        self.notes = ()
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _note(note):
+    """Returns the spacing tuple of a note element, or None for a grace note."""
+    voice = '1'
+    chord = False
+    duration = None
+    accidental = False
+    lyric_length = 0
+    for child in note:
+        tag = child.tag
+        if tag == 'grace':
+            return None
+        elif tag == 'chord':
+            chord = True
+        elif tag == 'duration':
+            duration = _number(child.text)
+        elif tag == 'voice':
+            voice = child.text or '1'
+        elif tag == 'accidental':
+            accidental = True
+        elif tag == 'pitch':
+            accidental = accidental or bool(_number(child.findtext('alter')))
+        elif tag == 'lyric':
+            lyric_length = max(lyric_length, len(child.findtext('text') or ''))
+    return voice, chord, duration, accidental, lyric_length
+
+
+def index_measure(measure):
+    """Returns the MeasureRecord of a measure element."""
+    record = MeasureRecord(measure)
+    notes = []
+    attributes_seen = False
+    for child in measure:
+        tag = child.tag
+        if tag == 'note':
+            note = _note(child)
+            if note is not None:
+                notes.append(note)
+        elif tag == 'direction':
+            sound = child.find('sound')
+            if sound is not None and 'tempo' in sound.attrib:
+                record.tempo = float(sound.get('tempo'))
+            dynamics = child.find('direction-type/dynamics')
+            if dynamics is not None and len(dynamics) > 0:
+                record.dynamic = dynamics[0].tag
+        elif tag == 'attributes' and not attributes_seen:
+            attributes_seen = True
+            record.key = child.find('key')
+            record.time = child.find('time')
+            record.divisions = child.find('divisions')
+            record.staves = child.find('staves')
+            record.clefs = tuple((clef.get('number'), clef) for clef in child.findall('clef'))
+        elif tag == 'print':
+            record.new_page = record.new_page or child.get('new-page') == 'yes'
+    record.notes = tuple(notes)
+    return record
+
+
+def index_measures(measures):
+    """Returns the MeasureRecords of a part's measures, in order."""
+    return [index_measure(measure) for measure in measures]
@@ -0,0 +1,93 @@
+def binary_search_fit(fits, low, high):
+    """
+    Finds the largest count in [low, high] for which fits(count) is True, one probe at a time.
+    Returns 0 if no count fits.
+    """
+    best_fit = 0
+    while low <= high:
+        mid = (low + high) // 2
+        if fits(mid):
+            best_fit = mid
+            low = mid + 1
+        else:
+            high = mid - 1
+    return best_fit
+
+
+def kary_candidates(low, high, k):
+    """
+    Splits [low, high] into k + 1 slices and returns the k interior probe points.
+    Small intervals are probed exhaustively.
+    """
+    size = high - low + 1
+    if size <= k:
+        return list(range(low, high + 1))
+    return [low + (size * j) // (k + 1) for j in range(1, k + 1)]
+
+
+def kary_search_fit(fits_many, low, high, k):
+    """
+    Finds the largest count in [low, high] that fits, probing k candidates per round.
+
+    fits_many(candidates) returns one boolean per candidate; the candidates of a round are
+    independent, so they can be rendered at the same time. Each round shrinks the interval
+    to about 1 / (k + 1) of its size, i.e. about log_k(n) rounds instead of log2(n) probes.
+    """
+    best_fit = 0
+    while low <= high:
+        candidates = kary_candidates(low, high, k)
+        for candidate, fit in zip(candidates, fits_many(candidates)):
+            if fit:
+                best_fit = max(best_fit, candidate)
+                low = max(low, candidate + 1)
+            else:
+                high = min(high, candidate - 1)
+    return best_fit
+
+
+def galloping_search_fit(fits, guess, low, high):
+    """
+    Finds the largest count in [low, high] that fits, starting from a guess such as the
+    previous section's fit. The step doubles away from the guess until the fit is bracketed,
+    then the bracket is bisected. A guess that is off by one costs two probes.
+    """
+    guess = min(max(guess, low), high)
+    step = 1
+    if fits(guess):
+        best_fit = guess
+        probe = guess + step
+        while probe <= high and fits(probe):
+            best_fit = probe
+            step *= 2
+            probe = best_fit + step
+        return binary_search_fit(fits, best_fit + 1, min(probe - 1, high)) or best_fit
+
+    too_many = guess
+    probe = guess - step
+    while probe >= low and not fits(probe):
+        too_many = probe
+        step *= 2
+        probe = too_many - step
+    if probe < low:
+        return binary_search_fit(fits, low, too_many - 1)
+    return binary_search_fit(fits, probe + 1, too_many - 1) or probe
+
+
+def interval_search_fit(fits, low, high, guess_low, guess_high):
+    """
+    Finds the largest count in [low, high] that fits, given an interval [guess_low, guess_high]
+    that is expected to contain it, e.g. from a layout estimate. One probe confirms each end of
+    the interval and the inside is bisected, so an exact guess costs two probes. If the fit lies
+    outside the interval, the search gallops on from the end that failed.
+    """
+    guess_low = min(max(guess_low, low), high)
+    guess_high = min(max(guess_high, guess_low), high)
+    if guess_high < high and fits(guess_high + 1):
+        if guess_high + 1 == high:
+            return high
+        return galloping_search_fit(fits, guess_high + 2, guess_high + 2, high) or guess_high + 1
+    if guess_low > low and not fits(guess_low):
+        return galloping_search_fit(fits, guess_low - 1, low, guess_low - 1)
+    if guess_low > low:
+        return binary_search_fit(fits, guess_low + 1, guess_high) or guess_low
+    return binary_search_fit(fits, low, guess_high)
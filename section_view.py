@@ -0,0 +1,56 @@
+import copy
+
+
+class SectionView:
+    """
+    A read-only view of the measures [start, stop) of a part, as a section document shows them.
+
+    Iterating a view yields the lead-in measure, the part's measures and the lead-out measure,
+    which is what DocumentAssembler.write takes. The source measures are never modified: a
+    measure that a section shows differently, such as its first measure with a page break and
+    the carried-over attributes, is an overlay, a copy made once and shared by every view
+    derived from the same section. Views can therefore be built and serialized from several
+    threads at the same time, as long as nothing mutates the source tree.
+    """
+    __slots__ = ('measures', 'start', 'stop', 'lead_in', 'lead_out', 'overlays')
+
+    def __init__(self, measures, start, stop, lead_in=None, lead_out=None, overlays=None):
+        self.measures = measures
+        self.start = start
+        self.stop = stop
+        self.lead_in = lead_in
+        self.lead_out = lead_out
+        self.overlays = overlays if overlays is not None else {}
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def measure(self, index):
+        """Returns the measure the view shows at part index index."""
+        return self.overlays.get(index, self.measures[index])
+
+    def __iter__(self):
+        if self.lead_in is not None:
+            yield self.lead_in
+        for index in range(self.start, self.stop):
+            yield self.measure(index)
+        if self.lead_out is not None:
+            yield self.lead_out
+
+    def replace(self, **changes):
+        """Returns a view like this one with the given fields changed; overlays are shared."""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return SectionView(**fields)
+
+    def overlaid(self, index, *edits):
+        """
+        Returns a view in which the measure at part index index is a copy of the one this view
+        shows there, with every edit (a function of the measure) applied to the copy.
+        """
+        measure = copy.deepcopy(self.measure(index))
+        for edit in edits:
+            edit(measure)
+        overlays = dict(self.overlays)
+        overlays[index] = measure
+        return self.replace(overlays=overlays)
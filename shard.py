@@ -0,0 +1,293 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import shlex
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, replace
+
+from batch import SPLITTERS, split_work, write_manifest
+from common import SplitResult
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    file_path TEXT NOT NULL UNIQUE,
+    output_dir TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+"""
+
+
+class JobQueue:
+    """
+    A queue of score jobs in a SQLite database that any number of worker processes, on any
+    number of nodes, can share through a common file system that supports SQLite's locking.
+
+    A job is 'queued', 'leased' by one worker until its lease_expires, or finished as 'done' or
+    'failed'. Workers extend their leases with heartbeat(); the leases of crashed workers expire
+    and their jobs are queued again, up to max_attempts leases per job, after which the job fails.
+    Every state change is a single transaction, so a result is either committed in full or not at
+    all, and only by the worker that holds the lease. Workers split into a scratch directory of
+    their own lease (see lease_dir), which complete() moves into place while the lease is held,
+    so a worker that lost its lease never touches the output of the one that took the job over.
+    """
+
+    def __init__(self, db_path, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        db = sqlite3.connect(db_path, timeout=60)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Yields a connection inside a write transaction, taken up front so that leases never race."""
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def enqueue(self, input_dir, output_root='split_musicxml', mode='iterative', extension='.musicxml'):
+        """Queues every score in input_dir, writing each to output_root/<work>. Returns the number of new jobs."""
+        now = time.time()
+        jobs = [(os.path.abspath(os.path.join(input_dir, name)),
+                 os.path.abspath(os.path.join(output_root, name[:-len(extension)])), mode, now)
+                for name in sorted(os.listdir(input_dir)) if name.endswith(extension)]
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (file_path, output_dir, mode, updated) VALUES (?, ?, ?, ?)',
+                           jobs)
+            return db.total_changes - before
+
+    def _expire(self, db, now):
+        """Queues the jobs of expired leases again, or fails those that used up their attempts."""
+        db.execute("UPDATE jobs SET status = 'failed', worker = NULL, updated = ?, "
+                   "result = '{\"error\": \"Lease expired ' || attempts || ' times\"}' "
+                   "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+        expired = db.execute("UPDATE jobs SET status = 'queued', worker = NULL, updated = ? "
+                             "WHERE status = 'leased' AND lease_expires < ?", (now, now)).rowcount
+        if expired:
+            logger.warning("Re-queued %s jobs with expired leases", expired)
+
+    def lease(self, worker, lease_seconds=60):
+        """Leases the next queued job to a worker. Returns (job_id, file_path, output_dir, mode), or None."""
+        now = time.time()
+        with self._transaction() as db:
+            self._expire(db, now)
+            job = db.execute("SELECT job_id, file_path, output_dir, mode FROM jobs WHERE status = 'queued' "
+                             "ORDER BY job_id LIMIT 1").fetchone()
+            if job is not None:
+                db.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, "
+                           "attempts = attempts + 1, updated = ? WHERE job_id = ?",
+                           (worker, now + lease_seconds, now, job[0]))
+        return job
+
+    def heartbeat(self, job_id, worker, lease_seconds=60):
+        """Extends a worker's lease on a job. Returns False if the worker no longer holds it."""
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                              "WHERE job_id = ? AND worker = ? AND status = 'leased'",
+                              (now + lease_seconds, now, job_id, worker)).rowcount == 1
+
+    def complete(self, job_id, worker, result, scratch_dir=None, lease_seconds=60):
+        """
+        Records the SplitResult of a leased job as done, or failed if it has an error, and
+        replaces the job's output directory with scratch_dir, the directory it was split into.
+        The lease is extended by lease_seconds first and the files are moved outside of any
+        transaction, so other workers are not blocked meanwhile; the result is then recorded in
+        a short transaction of its own. Returns False, recording and moving nothing, if the
+        worker no longer holds the lease, or recording nothing if it lost it during the move.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            job = db.execute("SELECT output_dir FROM jobs WHERE job_id = ? AND worker = ? AND status = 'leased'",
+                             (job_id, worker)).fetchone()
+            if job is None:
+                return False
+            db.execute('UPDATE jobs SET lease_expires = ?, updated = ? WHERE job_id = ?',
+                       (now + lease_seconds, now, job_id))
+        output_dir = job[0]
+        if scratch_dir is not None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.replace(scratch_dir, output_dir)
+        result = replace(result, output_dir=output_dir)
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET status = ?, result = ?, worker = NULL, lease_expires = NULL, "
+                              "updated = ? WHERE job_id = ? AND worker = ? AND status = 'leased'",
+                              ('failed' if result.error else 'done', json.dumps(asdict(result)), time.time(), job_id,
+                               worker)).rowcount == 1
+
+    def pending(self):
+        """Returns the number of jobs that are queued or leased."""
+        with self._transaction() as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased')").fetchone()[0]
+
+    def counts(self):
+        """Returns the number of jobs per status."""
+        with self._transaction() as db:
+            return dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def results(self):
+        """Returns the SplitResults of the finished jobs, in job order."""
+        with self._transaction() as db:
+            rows = db.execute("SELECT file_path, output_dir, result FROM jobs WHERE status IN ('done', 'failed') "
+                              "ORDER BY job_id").fetchall()
+        results = []
+        for file_path, output_dir, result in rows:
+            fields = json.loads(result)
+            fields.setdefault('file_path', file_path)
+            fields.setdefault('output_dir', output_dir)
+            results.append(SplitResult(**fields))
+        return results
+
+
+def lease_dir(output_dir):
+    """
+    Creates a scratch directory next to output_dir for one lease of its job, on the same file
+    system so that it can be renamed into place. It starts as a copy of the latest scratch
+    directory of an earlier, expired lease of the job, or else of output_dir, so that the split
+    resumes from their checkpoints (see checkpoint.Checkpoint), which only keep sections whose
+    outputs were copied intact. The scratch directories of expired leases are then removed:
+    their workers can no longer complete the job.
+    """
+    prefix = f'{os.path.basename(output_dir)}.lease-'
+    parent = os.path.dirname(output_dir) or '.'
+    stale_dirs = sorted(glob.glob(os.path.join(glob.escape(parent), glob.escape(prefix) + '*')), key=os.path.getmtime)
+    os.makedirs(parent, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    for seed_dir in stale_dirs[-1:] or [output_dir]:
+        try:
+            shutil.copytree(seed_dir, scratch_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns('*.tmp'))
+        except (FileNotFoundError, shutil.Error):
+            # A seed is only a head start, and its worker may still be changing it
+            logger.warning("Could not copy %s to the scratch directory of %s", seed_dir, output_dir)
+    for stale_dir in stale_dirs:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    return scratch_dir
+
+
+def _heartbeat(job_queue, job_id, worker, lease_seconds, stopped):
+    """Extends a lease every third of lease_seconds until stopped is set or the lease is lost."""
+    while not stopped.wait(lease_seconds / 3):
+        if not job_queue.heartbeat(job_id, worker, lease_seconds):
+            logger.warning("%s lost its lease on job %s", worker, job_id)
+            return
+
+
+def run_worker(db_path, worker=None, binary=None, cache_dir=None, lease_seconds=60, poll=0.0, timeout=300,
+               max_jobs=None):
+    """
+    Leases and splits jobs from the queue at db_path with batch.split_work until none are left,
+    or, with poll > 0, keeps waiting poll seconds for new ones. Returns the number of jobs run.
+    The worker name defaults to <host>:<pid>. Each job is split into a lease_dir, which is moved
+    to the job's output directory on completion, or removed if the lease was lost.
+    """
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    job_queue = JobQueue(db_path)
+    jobs_run = 0
+    while max_jobs is None or jobs_run < max_jobs:
+        job = job_queue.lease(worker, lease_seconds)
+        if job is None:
+            if poll > 0:
+                time.sleep(poll)
+                continue
+            # Leased jobs may still come back if their workers crash
+            if job_queue.pending() == 0:
+                break
+            time.sleep(min(1.0, lease_seconds / 3))
+            continue
+
+        job_id, file_path, output_dir, mode = job
+        logger.info("%s leased job %s: %s", worker, job_id, file_path)
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(job_queue, job_id, worker, lease_seconds, stopped),
+                                     daemon=True)
+        heartbeat.start()
+        scratch_dir = lease_dir(output_dir)
+        try:
+            result = split_work(file_path, scratch_dir, mode, binary, cache_dir, timeout=timeout)
+        finally:
+            stopped.set()
+            heartbeat.join()
+        if not job_queue.complete(job_id, worker, result, scratch_dir, lease_seconds):
+            logger.warning("%s lost the lease on job %s, its result was not recorded", worker, job_id)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        jobs_run += 1
+    return jobs_run
+
+
+def run_workers(db_path, workers=None, binary=None, cache_dir=None, lease_seconds=60, timeout=300):
+    """Runs `workers` local worker processes on the queue until it is empty. Returns the jobs run per worker."""
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_worker, db_path, None, binary, cache_dir, lease_seconds, 0.0, timeout)
+                   for _ in range(workers)]
+        return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split scores on any number of nodes through a shared job queue.')
+    parser.add_argument('--log-level', default='INFO')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = commands.add_parser('enqueue', help='queue every score in a directory')
+    enqueue_parser.add_argument('db_path')
+    enqueue_parser.add_argument('input_dir')
+    enqueue_parser.add_argument('--output', default='split_musicxml')
+    enqueue_parser.add_argument('--mode', choices=sorted(SPLITTERS), default='iterative')
+    enqueue_parser.add_argument('--extension', default='.musicxml')
+
+    work_parser = commands.add_parser('work', help='run worker processes on this node')
+    work_parser.add_argument('db_path')
+    work_parser.add_argument('--workers', type=int, default=None)
+    work_parser.add_argument('--renderer', default=None, help='renderer binary, defaults to the mode\'s MuseScore')
+    work_parser.add_argument('--cache-dir', default=None)
+    work_parser.add_argument('--lease', type=float, default=60, help='seconds a lease lasts without a heartbeat')
+    work_parser.add_argument('--timeout', type=float, default=300,
+                             help='seconds per converted file before a renderer run is killed')
+
+    manifest_parser = commands.add_parser('manifest', help='write the manifest of the finished jobs')
+    manifest_parser.add_argument('db_path')
+    manifest_parser.add_argument('--output', default='split_musicxml')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(processName)s %(message)s')
+    if args.command == 'enqueue':
+        logger.info("Queued %s jobs", JobQueue(args.db_path).enqueue(args.input_dir, args.output, args.mode,
+                                                                     args.extension))
+    elif args.command == 'work':
+        binary = shlex.split(args.renderer) if args.renderer else None
+        run_workers(args.db_path, args.workers, binary, args.cache_dir, args.lease, args.timeout)
+        logger.info("Queue: %s", JobQueue(args.db_path).counts())
+    else:
+        write_manifest(JobQueue(args.db_path).results(), args.output)
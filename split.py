@@ -1,160 +1,467 @@
-import xml.etree.ElementTree as ET
+import copy
+import logging
+import time
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from PyPDF2 import PdfReader, PdfWriter
-from common import find_last_tempo_and_dynamics, add_tempo_and_dynamics, find_last_key, add_key_signature, \
-    find_last_time, add_time_signature, find_last_clef, add_clef, find_last_divisions, add_divisions, \
-    copy_metadata_sections
+from assembler import DocumentAssembler
+from common import SplitResult, EMPTY_CARRY_STATE, copy_metadata_sections, build_carry_state_index, add_carry_state, \
+    advance_carry_state
+from render import AsyncRenderer, pdf_page_count
+from render_cache import RenderCache
+from score_index import index_measure, index_measures
+from instrument import NULL_TRACE, attach_trace
+from xmlbackend import ET, iterparse, parse, shared, tostring, write_document
 
 
-global_bad_pages = []
-global_bad_works = []
+logger = logging.getLogger(__name__)
 
+# A parsed score and the measure records and carry-state index of each of its parts
+ParsedScore = namedtuple('ParsedScore', ['root', 'parts'])
+ScorePart = namedtuple('ScorePart', ['part_id', 'records', 'carry_states'])
+
+
+def split_musicxml_by_page(file_path, output_dir='split_musicxml', renderer=None, streaming=False, trace=None,
+                           audio=None, render_once=False, score=None, part_workers=1):
+    """
+    Splits a MusicXML file at its original page breaks and returns a SplitResult.
+    PDFs that do not come out as exactly three padded pages are listed in its bad_pages.
+    With streaming=True the score is read with split_musicxml_by_page_streaming.
+    With an instrument.Trace the result also carries per-phase timings and counters.
+    With an audio.AudioExporter every page is also exported to audio, alongside the PDF renders.
+    With render_once=True each part is rendered once with its page breaks and the PDF is sliced
+    into pages (see render_parts); the padded page renders are only a fallback.
+    A ParsedScore from parse_score, e.g. one kept in memory by daemon.SplitDaemon, is split
+    instead of parsing file_path again; it is not modified.
+    With part_workers > 1 the pages of different parts are written and rendered at the same
+    time, each part with its own renderer.share() of renderer, which draws on renderer's
+    `workers` process slots; the outputs and page numbers are those of a serial split.
+    Streaming reads the file part by part, so it takes neither a ParsedScore nor part_workers:
+    combining them raises ValueError.
+    """
+    if streaming and (score is not None or part_workers > 1):
+        raise ValueError("streaming=True cannot be combined with score or part_workers > 1")
+    if streaming:
+        return split_musicxml_by_page_streaming(file_path, output_dir, renderer, trace, audio, render_once)
+    if renderer is None:
+        renderer = AsyncRenderer('mscore3')
+    trace = attach_trace(renderer, trace)
+    result = SplitResult(file_path, output_dir)
+    start_time = time.perf_counter()
+    renders_at_start = renderer.render_count
 
-def split_musicxml_by_page(file_path, output_dir='split_musicxml'):
     # Load the MusicXML file
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-    except ET.ParseError as e:
-        print(f"Error parsing MusicXML file: {e}")
-        return
+    if score is None:
+        try:
+            score = parse_score(file_path, trace)
+        except ET.ParseError as e:
+            logger.error("Error parsing MusicXML file: %s", e)
+            result.error = f"Error parsing MusicXML file: {e}"
+            return result
+    root = score.root
 
-    parts = root.findall('.//part')
-    print(f"Number of parts found: {len(parts)}")
+    logger.info("Number of parts found: %s", len(score.parts))
 
     page_number = 1
     page_measures = []
 
-    # Initialize variables to store the last known attributes
-    last_tempo = None
-    last_dynamic = None
-    last_key = None
-    last_time = None
-    last_clef = None
-    last_divisions = None
-
-    for part in parts:
-        part_id = part.get('id')
-        print(f"Part ID: {part_id}")
-
+    for part_id, records, carry_states in score.parts:
+        logger.info("Part ID: %s", part_id)
         current_measures = []
+        page_state = carry_states[0]
 
-        for measure in part.findall('measure'):
-            measure_number = int(measure.get('number', 0))
-
-            # Check for page breaks
-            is_new_page = any(
-                print_element.get('new-page') == 'yes'
-                for print_element in measure.findall('print')
-            )
+        for measure_index, record in enumerate(records):
+            measure = record.element
+            is_new_page = record.new_page
 
             if is_new_page and current_measures:
-                page_measures.append((page_number, part_id, current_measures.copy()))
-                # Update attributes for the next page
-                last_tempo, last_dynamic = find_last_tempo_and_dynamics(current_measures)
-                last_key = find_last_key(current_measures)
-                last_time = find_last_time(current_measures)
-                last_clef = find_last_clef(current_measures)
-                last_divisions = find_last_divisions(current_measures)
+                page_measures.append((page_number, part_id, current_measures.copy(), page_state))
+                # Attributes for the next page
+                page_state = carry_states[measure_index]
                 current_measures.clear()
                 page_number += 1
 
-            # Adjust the measure number for continuity
-            measure.set('number', str(measure_number))
-
             if is_new_page:
-                # Add tempo, dynamics, key, time signature, clef, and divisions if needed
-                add_divisions(measure, last_divisions)
-                add_tempo_and_dynamics(measure, last_tempo, last_dynamic)
-                add_key_signature(measure, last_key)
-                add_time_signature(measure, last_time)
-                add_clef(measure, last_clef)
-                print()
+                # Add tempo, dynamics, key, time signature, clef, and divisions if needed, on a copy so
+                # that the score can be split again
+                with trace.phase('carry_state'):
+                    measure = copy.deepcopy(measure)
+                    add_carry_state(measure, carry_states[measure_index])
             current_measures.append(measure)
 
         # Add remaining measures after the last page break
         if current_measures:
-            page_measures.append((page_number, part_id, current_measures.copy()))
+            page_measures.append((page_number, part_id, current_measures.copy(), page_state))
 
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
     # Write each page's measures to separate MusicXML files
-    for page_number, part_id, measures in page_measures:
-        new_root = ET.Element(root.tag, root.attrib)
-        copy_metadata_sections(root, new_root)
-
-        # Create a new part element with the measures for the current page
-        new_part = ET.SubElement(new_root, 'part', {'id': part_id})
-        for measure in measures:
-            new_part.append(measure)
-
-        # Write the new MusicXML file
-        new_file_path = os.path.join(output_dir, f'page_{page_number}_part_{part_id}.xml')
-        ET.ElementTree(new_root).write(new_file_path, xml_declaration=True, encoding='UTF-8', method='xml')
-        print(f'Page {page_number} {part_id} saved as {new_file_path}')
-        # save as audio
-        #os.system(f"mscore3 {new_file_path} -o {new_file_path.replace('.xml', '.wav')}")
-        # save as PDF
-        # Add an empty measure at the beginning
-        pdf_part = new_root.find(f".//part[@id='{part_id}']")
-
-        empty_measure_before = create_empty_measure(last_divisions)
-        # add_divisions(empty_measure_before, last_divisions)
-        # add_tempo_and_dynamics(empty_measure_before, last_tempo, last_dynamic)
-        # add_key_signature(empty_measure_before, last_key)
-        # add_time_signature(empty_measure_before, last_time)
-        # add_clef(empty_measure_before, last_clef)
-        pdf_part.insert(0, empty_measure_before)
-        # add  empty measures
-        # for i in range(94):
-        #     empty_measure = create_empty_measure(last_divisions)
-        #     pdf_part.insert(1, empty_measure)
-
-        # Add a page break after the original content
-        new_page_after = ET.Element('measure', number=str(len(measures) + 1))
-        new_page_element_after = ET.Element('print', {'new-page': 'yes'})
-        new_page_after.append(new_page_element_after)
-        pdf_part.append(new_page_after)
-
-        # write another empty bar with an new-page at the end
-        empty_measure_after = create_empty_measure(last_divisions)
-        add_divisions(empty_measure_before, last_divisions)
-        add_tempo_and_dynamics(empty_measure_before, last_tempo, last_dynamic)
-        add_key_signature(empty_measure_before, last_key)
-        add_time_signature(empty_measure_before, last_time)
-        add_clef(empty_measure_before, last_clef)
-        pdf_part.append(empty_measure_after)
-
-        # Write the modified MusicXML for PDF export
-        xmlpdf_file_path = os.path.join(output_dir, f'page_{page_number}_part_{part_id}_pdf.xml')
-        ET.ElementTree(new_root).write(xmlpdf_file_path, xml_declaration=True, encoding='UTF-8', method='xml')
-        pdf_file_path = xmlpdf_file_path.replace('.xml', '.pdf').replace("_pdf", "")
-        # Save as PDF using MuseScore
-        print(f"mscore3 {xmlpdf_file_path} -o {pdf_file_path}")
-        os.system(f"mscore3 {xmlpdf_file_path} -o {pdf_file_path}")
+    result.sections.extend({'part_id': part_id, 'page_number': number, 'measures': len(measures)}
+                           for number, part_id, measures, _ in page_measures)
+    if part_workers > 1:
+        part_pages = {}
+        for page in page_measures:
+            part_pages.setdefault(page[1], []).append(page)
+
+        def write_part(pages):
+            part_result = SplitResult(file_path, output_dir)
+            with renderer.share() as part_renderer:
+                write_and_render_pages(root, pages, output_dir, part_renderer, part_result, audio, render_once, trace)
+            return part_result.bad_pages
+
+        with ThreadPoolExecutor(max_workers=part_workers) as pool:
+            for bad_pages in pool.map(write_part, part_pages.values()):
+                result.bad_pages.extend(bad_pages)
+    else:
+        write_and_render_pages(root, page_measures, output_dir, renderer, result, audio, render_once, trace)
+    if audio is not None:
+        with trace.phase('audio'):
+            audio.flush()
+    result.page_number = page_number
+    result.render_count = renderer.render_count - renders_at_start
+    result.seconds = time.perf_counter() - start_time
+    result.trace = trace.to_dict()
+    return result
+
+
+def write_and_render_pages(root, page_measures, output_dir, renderer, result, audio=None, render_once=False,
+                           trace=NULL_TRACE):
+    """
+    Writes the (page number, part ID, measures, carry state) pages of a score with write_page and
+    renders their PDFs, adding the pages that do not come out as three pages to result.bad_pages.
+    """
+    pdf_jobs = []
+    part_documents = {}
+    assembler = DocumentAssembler(root) if render_once else None
+    for page_number, part_id, measures, state in page_measures:
+        with trace.phase('serialize'):
+            if render_once:
+                if part_id not in part_documents:
+                    part_documents[part_id] = PartDocument(assembler, part_id, output_dir)
+                part_documents[part_id].add_page(page_number, measures, state)
+                write_page(root, page_number, part_id, measures, state, output_dir, audio, padded=False)
+            else:
+                pdf_jobs.append(write_page(root, page_number, part_id, measures, state, output_dir, audio))
+
+    if render_once:
+        for part_document in part_documents.values():
+            part_document.close()
+        pdf_jobs = render_parts(list(part_documents.values()), renderer, trace)
+    render_pages(pdf_jobs, renderer, result, trace)
+
+
+def parse_score(file_path, trace=NULL_TRACE):
+    """
+    Parses a score and indexes its parts, renumbering their measures for continuity.
+    Raises ET.ParseError. split_musicxml_by_page does not modify a ParsedScore, so the same
+    one can be split any number of times.
+    """
+    with trace.phase('parse'):
+        root = parse(file_path).getroot()
+
+    parts = []
+    for part in root.findall('.//part'):
+        with trace.phase('index'):
+            records = index_measures(part.findall('measure'))
+        # Adjust the measure number for continuity
+        for record in records:
+            if record.number is not None:
+                record.element.set('number', str(record.number))
+        # The attributes in effect at every measure, looked up at each page start
+        with trace.phase('carry_state'):
+            carry_states = build_carry_state_index(records)
+        parts.append(ScorePart(part.get('id'), records, carry_states))
+    return ParsedScore(root, parts)
+
+
+def split_musicxml_by_page_streaming(file_path, output_dir='split_musicxml', renderer=None, trace=None, audio=None,
+                                     render_once=False):
+    """
+    Splits a MusicXML file at its original page breaks while parsing it with iterparse.
+
+    Each page is written as soon as the next <print new-page="yes"> is seen, and its measures
+    are then cleared and dropped from the tree, so memory is bounded by one page plus the carry
+    state instead of the whole score. Produces the same files as split_musicxml_by_page.
+    With render_once=True the measures are also appended to a full-score document per part as
+    they are emitted.
+    """
+    if renderer is None:
+        renderer = AsyncRenderer('mscore3')
+    trace = attach_trace(renderer, trace)
+    result = SplitResult(file_path, output_dir)
+    start_time = time.perf_counter()
+    renders_at_start = renderer.render_count
+    os.makedirs(output_dir, exist_ok=True)
 
+    root = None
+    part = None
+    depth = 0
+    page_number = 1
+    pdf_jobs = []
+    part_documents = []
+
+    def emit_page():
+        result.sections.append({'part_id': part_id, 'page_number': page_number, 'measures': len(current_measures)})
+        with trace.phase('serialize'):
+            if render_once:
+                part_documents[-1].add_page(page_number, current_measures, page_state)
+                write_page(root, page_number, part_id, current_measures, page_state, output_dir, audio, padded=False)
+            else:
+                pdf_jobs.append(write_page(root, page_number, part_id, current_measures, page_state, output_dir,
+                                           audio))
+        for finished in current_measures:
+            part.remove(finished)
+            finished.clear()
+        current_measures.clear()
+
+    try:
+        # The parse phase includes the pages written while streaming
+        with trace.phase('parse'):
+            for event, element in iterparse(file_path, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if root is None:
+                        root = element
+                    elif depth == 2 and element.tag == 'part':
+                        part = element
+                        part_id = part.get('id')
+                        logger.info("Part ID: %s", part_id)
+                        current_measures = []
+                        state = page_state = EMPTY_CARRY_STATE
+                        if render_once:
+                            part_documents.append(PartDocument(DocumentAssembler(root), part_id, output_dir))
+                    continue
+
+                depth -= 1
+                if part is None or element.tag not in ('measure', 'part') or depth > 2:
+                    continue
+
+                if element.tag == 'part':
+                    # Add remaining measures after the last page break
+                    if current_measures:
+                        emit_page()
+                    if render_once:
+                        part_documents[-1].close()
+                    root.remove(part)
+                    part = None
+                    continue
+
+                measure = element
+                record = index_measure(measure)
+                is_new_page = record.new_page
+
+                if is_new_page and current_measures:
+                    emit_page()
+                    # Attributes for the next page
+                    page_state = state
+                    page_number += 1
+
+                # Adjust the measure number for continuity
+                if record.number is not None:
+                    measure.set('number', str(record.number))
+
+                with trace.phase('carry_state'):
+                    next_state = advance_carry_state(state, record)
+                    if is_new_page:
+                        # Add tempo, dynamics, key, time signature, clef, and divisions if needed
+                        add_carry_state(measure, state)
+                state = next_state
+                current_measures.append(measure)
+    except ET.ParseError as e:
+        logger.error("Error parsing MusicXML file: %s", e)
+        result.error = f"Error parsing MusicXML file: {e}"
+        for part_document in part_documents:
+            part_document.close()
+        return result
+
+    if render_once:
+        pdf_jobs = render_parts(part_documents, renderer, trace)
+    render_pages(pdf_jobs, renderer, result, trace)
+    if audio is not None:
+        with trace.phase('audio'):
+            audio.flush()
+    result.page_number = page_number
+    result.render_count = renderer.render_count - renders_at_start
+    result.seconds = time.perf_counter() - start_time
+    result.trace = trace.to_dict()
+    return result
+
+
+def write_page(root, page_number, part_id, measures, state, output_dir, audio=None, padded=True):
+    """
+    Writes a page's measures to page_<n>_part_<id>.xml, and, if padded, a copy padded with an
+    empty page before and after it for PDF export. Returns the (padded xml, pdf) paths to render,
+    or None if not padded. The page file is queued for audio export if an audio.AudioExporter is given.
+    """
+    new_root = ET.Element(root.tag, root.attrib)
+    copy_metadata_sections(root, new_root)
+
+    # Create a new part element with the measures for the current page
+    new_part = ET.SubElement(new_root, 'part', {'id': part_id})
+    for measure in measures:
+        new_part.append(shared(measure))
+
+    # Write the new MusicXML file
+    new_file_path = os.path.join(output_dir, f'page_{page_number}_part_{part_id}.xml')
+    write_document(new_root, new_file_path)
+    logger.info('Page %s %s saved as %s', page_number, part_id, new_file_path)
+    # save as audio
+    if audio is not None:
+        audio.submit(new_file_path)
+    # save as PDF
+    if padded:
+        return write_padded_page(new_root, page_number, part_id, state, output_dir)
+    return None
+
+
+def write_padded_page(page_root, page_number, part_id, state, output_dir):
+    """
+    Pads a page document, as written by write_page, with an empty page before and after its
+    measures and writes it to page_<n>_part_<id>_pdf.xml. Returns the (padded xml, pdf) paths.
+    """
+    # Add an empty measure at the beginning
+    pdf_part = page_root.find(f".//part[@id='{part_id}']")
+    measure_count = len(pdf_part.findall('measure'))
+
+    empty_measure_before = create_empty_measure(state.divisions)
+    # add_carry_state(empty_measure_before, state)
+    pdf_part.insert(0, empty_measure_before)
+    # add  empty measures
+    # for i in range(94):
+    #     empty_measure = create_empty_measure(state.divisions)
+    #     pdf_part.insert(1, empty_measure)
+
+    # Add a page break after the original content
+    new_page_after = ET.Element('measure', number=str(measure_count + 1))
+    new_page_element_after = ET.Element('print', {'new-page': 'yes'})
+    new_page_after.append(new_page_element_after)
+    pdf_part.append(new_page_after)
+
+    # write another empty bar with an new-page at the end
+    empty_measure_after = create_empty_measure(state.divisions)
+    add_carry_state(empty_measure_before, state)
+    pdf_part.append(empty_measure_after)
+
+    # Write the modified MusicXML for PDF export
+    xmlpdf_file_path = os.path.join(output_dir, f'page_{page_number}_part_{part_id}_pdf.xml')
+    write_document(page_root, xmlpdf_file_path)
+    pdf_file_path = xmlpdf_file_path.replace('.xml', '.pdf').replace("_pdf", "")
+    return xmlpdf_file_path, pdf_file_path
+
+
+class PartDocument:
+    """
+    The full score of one part with its original page breaks, written page by page for
+    render_once. Records the page numbers the part's pages were emitted as and their carry
+    states, from which render_parts pads the pages it has to render one by one.
+    """
+
+    def __init__(self, assembler, part_id, output_dir):
+        self.assembler = assembler
+        self.part_id = part_id
+        self.output_dir = output_dir
+        self.xml_path = os.path.join(output_dir, f'part_{part_id}_full.xml')
+        self.pdf_path = self.xml_path.replace('.xml', '.pdf')
+        self.page_numbers = []
+        self.page_states = []
+        part_open, self.part_close = assembler.part_tags(part_id)
+        self.file = open(self.xml_path, 'wb')
+        self.file.write(assembler.header + part_open)
+
+    def add_page(self, page_number, measures, state):
+        """Appends a page's measures, serialized as they are now."""
+        self.page_numbers.append(page_number)
+        self.page_states.append(state)
+        self.file.write(b''.join(tostring(measure) for measure in measures))
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write(self.part_close + self.assembler.root_close)
+            self.file.close()
+
+    def page_pdf_path(self, page_number):
+        return os.path.join(self.output_dir, f'page_{page_number}_part_{self.part_id}.pdf')
+
+    def write_padded_pages(self):
+        """
+        Writes the padded documents of the part's pages from their page files, as write_page
+        does when rendering page by page. Returns their (padded xml, pdf) paths.
+        """
+        pdf_jobs = []
+        for page_number, state in zip(self.page_numbers, self.page_states):
+            page_path = os.path.join(self.output_dir, f'page_{page_number}_part_{self.part_id}.xml')
+            page_root = parse(page_path).getroot()
+            pdf_jobs.append(write_padded_page(page_root, page_number, self.part_id, state, self.output_dir))
+        return pdf_jobs
+
+
+def render_parts(part_documents, renderer, trace=NULL_TRACE):
+    """
+    Renders every part's full score once, all in one batch, and slices each PDF into the page
+    PDFs of the part with a single PdfReader. A part whose PDF does not have one page per
+    emitted page is left to the padded page renders: writes the padded documents of its pages
+    and returns their (padded xml, pdf) paths.
+    """
+    pdf_jobs = []
+    render_results = renderer.render_batch([(document.xml_path, document.pdf_path) for document in part_documents])
+    for document, render_result in zip(part_documents, render_results):
+        if render_result.page_count != len(document.page_numbers):
+            logger.warning("Part %s renders to %s pages instead of %s, rendering its pages one by one",
+                           document.part_id, render_result.page_count, len(document.page_numbers))
+            with trace.phase('serialize'):
+                pdf_jobs.extend(document.write_padded_pages())
+            trace.count('fallback_pages', len(document.page_numbers))
+        else:
+            with trace.phase('pdf'):
+                pdf_reader = PdfReader(document.pdf_path)
+                for pdf_page, page_number in zip(pdf_reader.pages, document.page_numbers):
+                    pdf_writer = PdfWriter()
+                    pdf_writer.add_page(pdf_page)
+                    with open(document.page_pdf_path(page_number), 'wb') as page_pdf_file:
+                        pdf_writer.write(page_pdf_file)
+            logger.info("Part %s sliced into %s page PDFs", document.part_id, len(document.page_numbers))
+
+        # Clean up the full score
+        os.remove(document.xml_path)
+        os.remove(document.pdf_path)
+    return pdf_jobs
+
+
+def render_pages(pdf_jobs, renderer, result, trace=NULL_TRACE):
+    """
+    Saves the padded pages as PDF using MuseScore, all in one batch, and keeps their middle pages.
+    Pages that do not come out as three pages are added to result.bad_pages.
+    """
+    for render_result in renderer.render_batch(pdf_jobs):
         # Check the PDF page count and adjust if needed
-        check_pdf_page_count_and_adjust(pdf_file_path)
-        print(
-            f'PDF with structure for page {page_number} for part {part_id} saved as {pdf_file_path.replace(".xml", ".pdf")}')
-    return page_number
+        with trace.phase('pdf'):
+            adjusted = check_pdf_page_count_and_adjust(render_result.pdf_path, render_result.page_count)
+        if not adjusted:
+            result.bad_pages.append(render_result.pdf_path)
+            trace.count('bad_pages')
+        logger.info('PDF with structure for %s saved as %s', render_result.xml_path, render_result.pdf_path)
 
 
-def check_pdf_page_count_and_adjust(pdf_file_path):
-    # Open the PDF
-    pdf_reader = PdfReader(pdf_file_path)
-    total_pages = len(pdf_reader.pages)
+def check_pdf_page_count_and_adjust(pdf_file_path, total_pages=None):
+    """
+    Keeps only the middle page of a padded three-page PDF.
+    Returns False, leaving the PDF untouched, if it does not have exactly three pages.
+    Pass the page count reported by the renderer to skip counting again.
+    """
+    if total_pages is None:
+        total_pages = pdf_page_count(pdf_file_path)
 
     # Check the page count
     if total_pages != 3:
         # Raise an exception if the PDF does not have exactly three pages
-        global_bad_pages.append(pdf_file_path)
-        global_bad_works.append(pdf_file_path.split("/")[1])
         #raise Exception(f"The PDF does not have exactly three pages. It has {total_pages} pages.")
+        return False
     else:
         # If the exception handling is desired instead of just raising an exception:
         # Remove the first and last pages to create a new PDF
+        pdf_reader = PdfReader(pdf_file_path)
         pdf_writer = PdfWriter()
         for page_number in range(1, total_pages - 1):  # Keep only the middle pages
             pdf_writer.add_page(pdf_reader.pages[page_number])
@@ -162,7 +469,8 @@ def check_pdf_page_count_and_adjust(pdf_file_path):
         # Write the new PDF file with the same name, replacing the original
         with open(pdf_file_path, 'wb') as new_pdf_file:
             pdf_writer.write(new_pdf_file)
-        print(f"Adjusted PDF saved with middle pages only: {pdf_file_path}")
+        logger.info("Adjusted PDF saved with middle pages only: %s", pdf_file_path)
+        return True
 
 
 def create_empty_measure(divisions):
@@ -174,7 +482,7 @@ def create_empty_measure(divisions):
 
     # Add divisions if specified
     if divisions is not None:
-        attributes.insert(0, divisions)
+        attributes.insert(0, shared(divisions))
 
     # Add an empty note for clarity
     note = ET.SubElement(measure, 'note')
@@ -188,23 +496,8 @@ def create_empty_measure(divisions):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     # Specify the path to your MusicXML file
     file_path = 'example/4240.musicxml'
-    split_musicxml_by_page(file_path)
-    # total = 0
-    # total_pages = 0
-    # for path in os.listdir("example"):
-    #     if path.endswith(".musicxml"):
-    #         page_number = split_musicxml_by_page(f"example/{path}", output_dir=f'split_musicxml/{path.replace(".musicxml", "")}')
-    #         total += 1
-    #         total_pages += page_number
-    #
-    #         print("total works:")
-    #         print(total)
-    #         print("total pages:")
-    #         print(total_pages)
-    #         print("bad pages:")
-    #         print(len(global_bad_pages))
-    #         print("bad works:")
-    #         print(len(set(global_bad_works)))
-
+    split_musicxml_by_page(file_path, renderer=AsyncRenderer('mscore3', cache=RenderCache()))
+    # For a whole directory of scores use batch.py
@@ -0,0 +1,125 @@
+"""
+A deterministic stand-in for MuseScore, for benchmarks and local runs without MuseScore.
+
+Usage mirrors the MuseScore command line:
+    python stub_renderer.py score.xml -o score.pdf
+    python stub_renderer.py score.xml -o score.mpos
+    python stub_renderer.py score.xml -o score.wav
+    python stub_renderer.py -j jobs.json
+    python stub_renderer.py --version
+
+The PDF page count is computed from measure counts: the first part is cut at every measure
+with <print new-page="yes">, and each stretch fills ceil(measures / MEASURES_PER_PAGE) pages.
+MEASURES_PER_PAGE can be set with the STUB_MEASURES_PER_PAGE environment variable.
+Measure positions (.mpos) place MEASURES_PER_SYSTEM measures on each system of a page.
+Audio (.wav) is silence, a quarter of a second per measure.
+"""
+import json
+import math
+import os
+import sys
+import wave
+import xml.etree.ElementTree as ET
+
+
+MEASURES_PER_PAGE = int(os.environ.get('STUB_MEASURES_PER_PAGE', 16))
+MEASURES_PER_SYSTEM = 4
+SYSTEM_HEIGHT = 150
+VERSION = 'stub_renderer 1.0'
+
+
+def measure_layout(xml_path, measures_per_page=MEASURES_PER_PAGE):
+    """Returns the page and the position on its page of every measure of the first part."""
+    part = ET.parse(xml_path).getroot().find('part')
+    measures = part.findall('measure') if part is not None else []
+    layout = []
+    page = 0
+    stretch = 0
+    for measure in measures:
+        is_new_page = any(print_element.get('new-page') == 'yes' for print_element in measure.findall('print'))
+        if is_new_page and stretch:
+            page += math.ceil(stretch / measures_per_page)
+            stretch = 0
+        layout.append((page + stretch // measures_per_page, stretch % measures_per_page))
+        stretch += 1
+    return layout
+
+
+def count_pages(xml_path, measures_per_page=MEASURES_PER_PAGE):
+    """Returns the number of pages the stub lays the first part of a MusicXML file out on."""
+    layout = measure_layout(xml_path, measures_per_page)
+    return layout[-1][0] + 1 if layout else 1
+
+
+def write_pdf(pdf_path, page_count):
+    """Writes a minimal, valid PDF with the given number of blank A4 pages."""
+    kids = ' '.join(f'{3 + page} 0 R' for page in range(page_count))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Type /Pages /Kids [{kids}] /Count {page_count} >>'.encode('ascii')]
+    objects += [b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>'] * page_count
+
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref_offset = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf)
+
+
+def write_mpos(mpos_path, layout):
+    """Writes MuseScore-style measure positions, one element per measure."""
+    score = ET.Element('score')
+    elements = ET.SubElement(score, 'elements')
+    events = ET.SubElement(score, 'events')
+    for number, (page, slot) in enumerate(layout):
+        system, column = divmod(slot, MEASURES_PER_SYSTEM)
+        ET.SubElement(elements, 'element', id=str(number), x=str(200 + column * 1000), y=str(300 + system * 2 * SYSTEM_HEIGHT),
+                      sx='1000', sy=str(SYSTEM_HEIGHT), page=str(page))
+        ET.SubElement(events, 'event', elid=str(number), position=str(number * 1920))
+    ET.ElementTree(score).write(mpos_path, encoding='UTF-8', xml_declaration=True)
+
+
+def write_wav(wav_path, seconds, frame_rate=8000):
+    """Writes a silent mono WAV file."""
+    with wave.open(wav_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(frame_rate)
+        f.writeframes(b'\0\0' * int(seconds * frame_rate))
+
+
+def convert(in_path, out_path):
+    """Converts one file; PDF, measure position and WAV output are supported."""
+    if out_path.endswith('.pdf'):
+        write_pdf(out_path, count_pages(in_path))
+    elif out_path.endswith('.mpos'):
+        write_mpos(out_path, measure_layout(in_path))
+    elif out_path.endswith('.wav'):
+        write_wav(out_path, len(measure_layout(in_path)) / 4)
+    else:
+        raise SystemExit(f"stub_renderer cannot write {out_path}")
+
+
+def main(argv):
+    if argv[:1] == ['--version']:
+        print(VERSION)
+    elif argv[:1] == ['-j']:
+        with open(argv[1], encoding='UTF-8') as f:
+            jobs = json.load(f)
+        for job in jobs:
+            outputs = job['out'] if isinstance(job['out'], list) else [job['out']]
+            for out_path in outputs:
+                convert(job['in'], out_path)
+    elif len(argv) == 3 and argv[1] == '-o':
+        convert(argv[0], argv[2])
+    else:
+        raise SystemExit(__doc__)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
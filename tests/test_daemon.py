@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import daemon
+from benchmark import STUB_RENDERER, synthetic_score
+
+
+@pytest.fixture
+def served():
+    """Serves a two-worker SplitDaemon on the stub renderer. Yields the daemon and its URL."""
+    split_daemon = daemon.SplitDaemon(STUB_RENDERER, workers=2)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), daemon.DaemonRequestHandler)
+    server.split_daemon = split_daemon
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield split_daemon, f'http://127.0.0.1:{server.server_address[1]}'
+    split_daemon.shutdown()
+    server.shutdown()
+    server.server_close()
+
+
+def _call(url, method='GET', body=None):
+    """Sends a request and returns its status and JSON reply. A str body is sent as is."""
+    data = body.encode('UTF-8') if isinstance(body, str) else json.dumps(body).encode('UTF-8')
+    request = urllib.request.Request(url, method=method, data=data if body is not None else None)
+    try:
+        with urllib.request.urlopen(request) as reply:
+            return reply.status, json.load(reply)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def _write_score(file_path, measure_count=40, seed=0):
+    synthetic_score(measure_count, 1, seed=seed).write(file_path, encoding='UTF-8', xml_declaration=True)
+    return str(file_path)
+
+
+def test_jobs_are_split_and_reported(served, tmp_path):
+    split_daemon, url = served
+    score_path = _write_score(tmp_path / 'work.musicxml')
+    status, job = _call(f'{url}/jobs', 'POST', {'file_path': score_path, 'output_dir': str(tmp_path / 'out')})
+    assert status == 202 and job['status'] == 'queued'
+    split_daemon.wait()
+
+    status, job = _call(f"{url}/jobs/{job['job_id']}")
+    assert status == 200 and job['status'] == 'done'
+    assert job['result']['error'] is None and job['result']['sections']
+    assert os.path.exists(tmp_path / 'out' / 'page_1_part_P1.xml')
+    assert _call(f'{url}/jobs/999')[0] == 404
+
+    status, metrics = _call(f'{url}/metrics')
+    assert status == 200
+    assert metrics['completed'] == 1 and metrics['failed'] == 0 and metrics['queue_depth'] == 0
+    assert metrics['latency']['count'] == 1 and metrics['render_count'] == job['result']['render_count']
+
+
+@pytest.mark.parametrize('body', ['{"output_dir": "out"}', 'not json', '[]'])
+def test_a_bad_job_is_refused(served, body):
+    split_daemon, url = served
+    status, reply = _call(f'{url}/jobs', 'POST', body)
+    assert status == 400 and reply['error'].startswith('Bad job')
+    assert not split_daemon.jobs
+
+
+def test_the_score_cache_parses_a_score_once_per_version(served, tmp_path):
+    split_daemon, url = served
+    score_path = _write_score(tmp_path / 'work.musicxml')
+    for number in range(3):
+        _call(f'{url}/jobs', 'POST', {'file_path': score_path, 'output_dir': str(tmp_path / f'out_{number}')})
+    split_daemon.wait()
+    assert _call(f'{url}/metrics')[1]['score_cache'] == {'hits': 2, 'misses': 1}
+
+    # An edited score is parsed again
+    _write_score(score_path, measure_count=50, seed=1)
+    _call(f'{url}/jobs', 'POST', {'file_path': score_path, 'output_dir': str(tmp_path / 'out_edited')})
+    split_daemon.wait()
+    metrics = _call(f'{url}/metrics')[1]
+    assert metrics['score_cache'] == {'hits': 2, 'misses': 2} and metrics['completed'] == 4
+
+
+def test_a_draining_daemon_finishes_its_jobs_and_refuses_new_ones(served, tmp_path):
+    split_daemon, url = served
+    score_path = _write_score(tmp_path / 'work.musicxml', measure_count=80)
+    job_ids = [_call(f'{url}/jobs', 'POST', {'file_path': score_path, 'output_dir': str(tmp_path / f'out_{number}')})
+               [1]['job_id'] for number in range(4)]
+
+    assert _call(f'{url}/shutdown', 'POST', {}) == (202, {'draining': True})
+    # The daemon drains on a thread of its own
+    while not _call(f'{url}/metrics')[1]['draining']:
+        time.sleep(0.01)
+    split_daemon.wait()
+    status, reply = _call(f'{url}/jobs', 'POST', {'file_path': score_path, 'output_dir': str(tmp_path / 'late')})
+    assert status == 503 and 'shutting down' in reply['error']
+
+    assert [_call(f'{url}/jobs/{job_id}')[1]['status'] for job_id in job_ids] == ['done'] * 4
+    metrics = _call(f'{url}/metrics')[1]
+    assert metrics['draining'] and metrics['completed'] == 4
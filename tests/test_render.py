@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import ProcessSlots, fast_pdf_page_count, pdf_page_count
+from stub_renderer import write_pdf
+
+
+def _write_indirect_count_pdf(pdf_path, page_count):
+    """Writes a PDF whose page tree root gives its /Count as a reference to an integer object."""
+    count_object = 3 + page_count
+    kids = ' '.join(f'{3 + page} 0 R' for page in range(page_count))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Type /Pages /Kids [{kids}] /Count {count_object} 0 R >>'.encode('ascii')]
+    objects += [b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>'] * page_count
+    objects.append(str(page_count).encode('ascii'))
+
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref_offset = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf)
+
+
+@pytest.mark.parametrize('page_count', [1, 3, 12])
+def test_direct_count(tmp_path, page_count):
+    pdf_path = str(tmp_path / 'direct.pdf')
+    write_pdf(pdf_path, page_count)
+    assert fast_pdf_page_count(pdf_path) == page_count
+
+
+@pytest.mark.parametrize('page_count', [2, 10])
+def test_indirect_count_falls_back(tmp_path, page_count):
+    # The count object is number 5 with 2 pages and number 13 with 10 pages
+    pdf_path = str(tmp_path / 'indirect.pdf')
+    _write_indirect_count_pdf(pdf_path, page_count)
+    with pytest.raises(ValueError):
+        fast_pdf_page_count(pdf_path)
+    assert pdf_page_count(pdf_path) == page_count
+
+
+def test_a_cancelled_waiter_takes_no_process_slot():
+    slots = ProcessSlots(1)
+
+    async def wait_for_slot():
+        async with slots:
+            pass
+
+    async def main():
+        with slots:
+            waiter = asyncio.ensure_future(wait_for_slot())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        # The slot was freed, not handed to the cancelled waiter
+        await asyncio.wait_for(wait_for_slot(), 1)
+
+    asyncio.run(main())
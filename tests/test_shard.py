@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shard
+from batch import split_work
+from benchmark import STUB_RENDERER, synthetic_score
+from common import SplitResult
+
+
+def _enqueue(tmp_path, score_count=3):
+    input_dir = tmp_path / 'scores'
+    input_dir.mkdir()
+    for number in range(score_count):
+        synthetic_score(40, 1, seed=number).write(input_dir / f'work_{number}.musicxml', encoding='UTF-8',
+                                                  xml_declaration=True)
+    (input_dir / 'broken.musicxml').write_text('<score-partwise>')
+    db_path = str(tmp_path / 'jobs.db')
+    job_queue = shard.JobQueue(db_path)
+    assert job_queue.enqueue(str(input_dir), str(tmp_path / 'out')) == score_count + 1
+    return db_path, job_queue
+
+
+def test_workers_finish_the_job_of_a_crashed_worker(tmp_path):
+    db_path, job_queue = _enqueue(tmp_path)
+    # A worker that leases a job and crashes before its first heartbeat
+    job_id, _, output_dir, _ = job_queue.lease('crashed', lease_seconds=1)
+    shard.lease_dir(output_dir)
+
+    jobs_run = shard.run_workers(db_path, workers=3, binary=STUB_RENDERER, lease_seconds=1)
+
+    assert sum(jobs_run) == 4
+    assert job_queue.counts() == {'done': 3, 'failed': 1}
+    results = {os.path.basename(result.file_path): result for result in job_queue.results()}
+    assert results['broken.musicxml'].error
+    for number in range(3):
+        result = results[f'work_{number}.musicxml']
+        assert result.error is None and result.sections
+        assert result.output_dir == str(tmp_path / 'out' / f'work_{number}')
+        assert os.path.exists(os.path.join(result.output_dir, 'section_1_part_P1.xml'))
+    assert not [name for name in os.listdir(tmp_path / 'out') if '.lease-' in name]
+
+
+def test_a_lost_lease_does_not_replace_the_output(tmp_path):
+    db_path, job_queue = _enqueue(tmp_path, score_count=1)
+    job_id, file_path, output_dir, _ = job_queue.lease('slow', lease_seconds=0.1)
+    slow_dir = shard.lease_dir(output_dir)
+    time.sleep(0.2)
+
+    # The lease expired, so the job goes to the next worker, which completes it
+    assert job_queue.lease('fast', lease_seconds=60)[0] == job_id
+    assert not job_queue.heartbeat(job_id, 'slow')
+    fast_dir = shard.lease_dir(output_dir)
+    assert not os.path.exists(slow_dir)
+    with open(os.path.join(fast_dir, 'section_1_part_P1.xml'), 'w') as f:
+        f.write('fast')
+    assert job_queue.complete(job_id, 'fast', SplitResult(file_path, fast_dir), fast_dir)
+
+    os.makedirs(slow_dir)
+    with open(os.path.join(slow_dir, 'section_1_part_P1.xml'), 'w') as f:
+        f.write('slow')
+    assert not job_queue.complete(job_id, 'slow', SplitResult(file_path, slow_dir), slow_dir)
+    with open(os.path.join(output_dir, 'section_1_part_P1.xml')) as f:
+        assert f.read() == 'fast'
+    assert job_queue.results()[0].output_dir == output_dir
+
+
+def test_workers_resume_from_the_checkpoints_of_earlier_splits(tmp_path):
+    db_path, job_queue = _enqueue(tmp_path, score_count=2)
+    shard.run_worker(db_path, binary=STUB_RENDERER, max_jobs=1)
+    # A worker that splits work_0 in full and crashes before completing the job
+    job_id, file_path, output_dir, mode = job_queue.lease('crashed', lease_seconds=0.1)
+    split_work(file_path, shard.lease_dir(output_dir), mode, STUB_RENDERER)
+    time.sleep(0.2)
+
+    shard.run_worker(db_path, binary=STUB_RENDERER)
+    results = {os.path.basename(result.file_path): result for result in job_queue.results()}
+    assert results['work_0.musicxml'].sections and results['work_0.musicxml'].render_count == 0
+
+    # The next split of a finished job resumes from its output directory
+    scratch_dir = shard.lease_dir(results['work_1.musicxml'].output_dir)
+    assert split_work(results['work_1.musicxml'].file_path, scratch_dir, mode, STUB_RENDERER).render_count == 0
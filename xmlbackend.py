@@ -0,0 +1,91 @@
+"""
+The XML library the splitters parse, mutate and serialize scores with.
+
+lxml is used when it is installed and xml.etree.ElementTree otherwise; setting the
+SPLIT_SCORES_XML_BACKEND environment variable to 'etree' forces the fallback. ET is the
+chosen library's ElementTree module. Both backends write byte-identical documents through
+tostring and write_document: lxml's self-closing tags and tab references are rewritten the
+way ElementTree writes them, and comments and processing instructions, which ElementTree
+drops when parsing, are dropped by the lxml parser as well. The MusicXML namespaces in NAMESPACES
+are registered with ElementTree, so namespaced attributes keep their usual prefixes; other
+namespaces are written with ElementTree's generated prefixes under etree only.
+
+lxml elements have a single parent, while ElementTree lets the same element appear under
+several parents. Elements that are inserted into a second tree, such as the carried-over key
+and the metadata sections, are passed through shared(), which copies them under lxml.
+"""
+import copy
+import os
+
+BACKEND = os.environ.get('SPLIT_SCORES_XML_BACKEND', 'lxml')
+
+try:
+    if BACKEND != 'lxml':
+        raise ImportError(BACKEND)
+    from lxml import etree as ET
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML = False
+
+BACKEND = 'lxml' if LXML else 'etree'
+
+# The namespaces MusicXML uses besides xml:, so that ElementTree writes their attributes with the
+# prefixes lxml keeps from the source, e.g. xlink:href rather than ns0:href
+NAMESPACES = {'xlink': 'http://www.w3.org/1999/xlink'}
+if not LXML:
+    for prefix, uri in NAMESPACES.items():
+        ET.register_namespace(prefix, uri)
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+if LXML:
+    def _parser():
+        return ET.XMLParser(remove_comments=True, remove_pis=True, resolve_entities=False, huge_tree=True)
+
+
+def parse(file_path):
+    """Parses a score and returns its ElementTree."""
+    if LXML:
+        return ET.parse(file_path, _parser())
+    return ET.parse(file_path)
+
+
+def iterparse(file_path, events=('end',)):
+    """Parses a score incrementally, yielding (event, element) pairs as ElementTree.iterparse does."""
+    if LXML:
+        return ET.iterparse(file_path, events=events, remove_comments=True, remove_pis=True, resolve_entities=False,
+                            huge_tree=True)
+    return ET.iterparse(file_path, events=events)
+
+
+def tostring(element):
+    """Serializes an element, and its tail, to UTF-8 bytes without an XML declaration."""
+    if LXML:
+        # lxml writes <a/> where ElementTree writes <a />; '/>' cannot occur in escaped text
+        return ET.tostring(element, encoding='UTF-8').replace(b'/>', b' />').replace(b'&#9;', b'&#09;')
+    return ET.tostring(element, encoding='UTF-8')
+
+
+def open_and_close_tags(tag, attrib):
+    """Returns the serialized start and end tags of an element."""
+    element = ET.Element(tag, attrib)
+    if LXML:
+        element.text = ''
+        serialized = tostring(element)
+    else:
+        serialized = ET.tostring(element, encoding='UTF-8', short_empty_elements=False)
+    split_at = serialized.rindex(b'</')
+    return serialized[:split_at], serialized[split_at:]
+
+
+def write_document(root, file_path):
+    """Writes a document with the given root element, after an XML declaration."""
+    with open(file_path, 'wb') as f:
+        f.write(XML_DECLARATION)
+        f.write(tostring(root))
+
+
+def shared(element):
+    """Returns element, ready to be inserted into another parent: a copy under lxml, itself otherwise."""
+    return copy.deepcopy(element) if LXML else element